@@ -4,13 +4,26 @@ import asyncio
 import random
 import threading
 import time
-import requests
+import httpx
+try: import redis.asyncio as aioredis  # optional, only for STATE_BACKEND=redis
+except ImportError: aioredis = None
+import json
+import secrets
+import signal
 import sqlite3
+import struct
+import base64
+import binascii
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
+from functools import lru_cache, partial
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
+    Application, ApplicationHandlerStop, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler,
     filters, ContextTypes
 )
 
@@ -19,6 +32,8 @@ TOKEN = os.environ.get("TELEGRAM_TOKEN")
 ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID")
 TMDB_API_KEY = os.environ.get("TMDB_API_KEY")
 
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+
 if not TOKEN: raise RuntimeError("FATAL: TELEGRAM_TOKEN not set.")
 if ADMIN_CHAT_ID: ADMIN_CHAT_ID = int(ADMIN_CHAT_ID)
 if not TMDB_API_KEY: print("WARNING: TMDB_API_KEY not set. Movie/Anime suggestions will use a basic list.")
@@ -28,77 +43,561 @@ PROMO_CODES = {
     "WELCOME10": 10, "SPECIALGIFT": 25, "WEEKEND5": 5, "ULTIMATEVIP2024": 200
 }
 
+# --- METRICS ---
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape_label(value): return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+def _label_text(names, values):
+    if not names: return ""
+    return "{" + ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+class Counter:
+    kind = "counter"
+    def __init__(self, name, doc, labels=()): self.name, self.doc, self.labels, self.values = name, doc, labels, {}
+    def inc(self, *labels, amount=1): self.values[labels] = self.values.get(labels, 0) + amount
+    def render(self): return [f"{self.name}{_label_text(self.labels, labels)} {value}" for labels, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+    def set(self, value, *labels): self.values[labels] = value
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect plus two additions, cheap enough for the relay path."""
+    kind = "histogram"
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS): self.name, self.doc, self.labels, self.buckets, self.series = name, doc, labels, buckets, {}
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None: series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1; series[1] += value
+    def render(self):
+        lines = []
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count; lines.append(f"{self.name}_bucket{_label_text(self.labels + ('le',), labels + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, labels)} {total}"); lines.append(f"{self.name}_count{_label_text(self.labels, labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """Process-wide metrics rendered in the Prometheus text format. Collectors are async callables run
+    on every scrape to refresh gauges that are cheaper to read on demand than to keep updated."""
+    def __init__(self): self._metrics, self._collectors = [], []
+    def _add(self, metric): self._metrics.append(metric); return metric
+    def counter(self, name, doc, labels=()): return self._add(Counter(name, doc, labels))
+    def gauge(self, name, doc, labels=()): return self._add(Gauge(name, doc, labels))
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS): return self._add(Histogram(name, doc, labels, buckets))
+    def collector(self, fn): self._collectors.append(fn); return fn
+    async def render(self):
+        for collect in self._collectors:
+            try: await collect()
+            except Exception as e: print(f"Metrics collector {collect.__name__} failed: {e}")
+        lines = []
+        for metric in self._metrics: lines += [f"# HELP {metric.name} {metric.doc}", f"# TYPE {metric.name} {metric.kind}"] + metric.render()
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Time spent handling an update, by handler.", ("handler",))
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Exceptions that escaped a handler.", ("error",))
+LOCK_WAIT_SECONDS = metrics.histogram("bot_user_lock_wait_seconds", "Time spent waiting for a per-user lock stripe.", ("site",))
+LOCK_HOLD_SECONDS = metrics.histogram("bot_user_lock_hold_seconds", "Time a per-user lock stripe was held.", ("site",))
+DB_SECONDS = metrics.histogram("bot_db_seconds", "SQLite call latency as seen from the event loop, executor queueing included.", ("op",))
+SWALLOWED_ERRORS = metrics.counter("bot_swallowed_exceptions_total", "Exceptions caught and ignored, by call site.", ("site",))
+RELAY_FAILURES = metrics.counter("bot_relay_failures_total", "Relayed messages that could not be delivered to the partner.")
+
+def timed(callback):
+    """Wrap a handler so its latency lands in bot_handler_seconds under the function's name."""
+    name = callback.__name__
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try: return await callback(update, context)
+        finally: HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+    wrapper.__name__ = wrapper.__qualname__ = name
+    return wrapper
+
 # --- DATABASE SETUP ---
-def db_connect(): return sqlite3.connect('users.db', check_same_thread=False)
+DB_PATH = os.environ.get("DB_PATH", "users.db")
+DB_READERS = int(os.environ.get("DB_READERS", "4"))
+
+class Storage:
+    """Long-lived SQLite connections in WAL mode: one writer thread plus a pool of reader threads.
+    Statements run on executor threads so the event loop never blocks on disk; each connection
+    keeps its compiled statements cached, so the fixed SQL strings below are prepared once."""
+    def __init__(self, path, readers=4):
+        self.path, self._local, self._conns, self._writer = path, threading.local(), [], None
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256); conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL"); conn.execute("PRAGMA busy_timeout=5000")
+        self._conns.append(conn); return conn
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None: conn = self._local.conn = self._open()
+        return conn
+    def _writer_conn(self):
+        if self._writer is None: self._writer = self._open()
+        return self._writer
+    def _fetchone(self, sql, params): return self._reader().execute(sql, params).fetchone()
+    def _fetchall(self, sql, params): return self._reader().execute(sql, params).fetchall()
+    def _execute(self, sql, params):
+        conn = self._writer_conn(); cursor = conn.execute(sql, params); conn.commit(); return cursor.rowcount
+    def _executemany(self, sql, rows):
+        conn = self._writer_conn(); conn.executemany(sql, rows); conn.commit()
+    def _transaction(self, statements):
+        conn = self._writer_conn()
+        with conn:
+            for sql, params in statements: conn.execute(sql, params)
+    def _call(self, fn, args):
+        conn = self._writer_conn()
+        with conn: return fn(conn, *args)
+    def _executescript(self, script): self._writer_conn().executescript(script)
+    def _add_columns(self, table, columns):
+        conn = self._writer_conn(); existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for name, decl in columns.items():
+            if name not in existing: conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+        conn.commit()
+    async def _run(self, op, pool, fn, *args):
+        started = time.perf_counter()
+        try: return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+        finally: DB_SECONDS.observe(time.perf_counter() - started, op)
+    async def fetchone(self, sql, params=()): return await self._run("fetchone", self._read_pool, self._fetchone, sql, params)
+    async def fetchall(self, sql, params=()): return await self._run("fetchall", self._read_pool, self._fetchall, sql, params)
+    async def execute(self, sql, params=()): return await self._run("execute", self._write_pool, self._execute, sql, params)
+    async def executemany(self, sql, rows): await self._run("executemany", self._write_pool, self._executemany, sql, rows)
+    async def transact(self, fn, *args):
+        """Run `fn(conn, *args)` on the writer thread inside one transaction and return its result."""
+        return await self._run("transact", self._write_pool, self._call, fn, args)
+    def submit(self, statements):
+        """Queue `(sql, params)` statements as one transaction without waiting for it. The single writer
+        thread runs submissions in call order, so journals built on this stay consistent."""
+        future = self._write_pool.submit(self._transaction, statements)
+        future.add_done_callback(lambda f: f.exception() and (SWALLOWED_ERRORS.inc("db_submit"), print(f"Database write failed: {f.exception()}")))
+        return future
+    def setup(self, script): self._write_pool.submit(self._executescript, script).result()
+    def add_columns(self, table, columns): self._write_pool.submit(self._add_columns, table, columns).result()
+    def close(self):
+        self._write_pool.shutdown(wait=True); self._read_pool.shutdown(wait=True)
+        for conn in self._conns: conn.close()
+        self._conns.clear()
+
+storage = Storage(DB_PATH, DB_READERS)
 def setup_database():
-    conn = db_connect()
-    cursor = conn.cursor()
-    cursor.execute('''
+    storage.setup('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY, first_name TEXT, age TEXT, region TEXT, gender TEXT,
             points INTEGER DEFAULT 5, reputation_score REAL DEFAULT 7.0, total_chats INTEGER DEFAULT 0,
             positive_ratings INTEGER DEFAULT 0
-        )''')
-    cursor.execute('''
+        );
         CREATE TABLE IF NOT EXISTS redeemed_codes (
             user_id INTEGER, code TEXT, PRIMARY KEY (user_id, code)
-        )''')
-    conn.commit(); conn.close(); print("Database setup complete.")
-
-def get_user(user_id):
-    conn = db_connect(); conn.row_factory = sqlite3.Row; cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)); user_data = cursor.fetchone(); conn.close()
-    return dict(user_data) if user_data else None
-def add_user(user_id, first_name):
-    if get_user(user_id): return False
-    conn = db_connect(); cursor = conn.cursor()
-    cursor.execute("INSERT INTO users (user_id, first_name, points) VALUES (?, ?, 5)", (user_id, first_name)); conn.commit(); conn.close()
-    return True
-def update_user(user_id, field, value):
-    conn = db_connect(); cursor = conn.cursor()
-    cursor.execute(f"UPDATE users SET {field} = ? WHERE user_id = ?", (value, user_id)); conn.commit(); conn.close()
-def grant_points(user_id, amount):
-    conn = db_connect(); cursor = conn.cursor()
-    cursor.execute("UPDATE users SET points = points + ? WHERE user_id = ?", (amount, user_id)); conn.commit(); conn.close()
-def has_redeemed_code(user_id, code):
-    conn = db_connect(); cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM redeemed_codes WHERE user_id = ? AND code = ?", (user_id, code)); result = cursor.fetchone(); conn.close()
-    return result is not None
-def mark_code_as_redeemed(user_id, code):
-    conn = db_connect(); cursor = conn.cursor()
-    cursor.execute("INSERT INTO redeemed_codes (user_id, code) VALUES (?, ?)", (user_id, code)); conn.commit(); conn.close()
-
-# --- WEB SERVER FOR KEEP-ALIVE ---
-app = Flask(__name__)
-@app.route('/')
-def index(): return "Bot is alive and running!"
-def run_flask(): app.run(host='0.0.0.0', port=8080)
-def keep_alive():
-    flask_thread = threading.Thread(target=run_flask); flask_thread.daemon = True; flask_thread.start()
-    while True:
-        time.sleep(300)
-        try: requests.get(f"https://{os.environ['REPLIT_DEV_DOMAIN']}", timeout=10 )
-        except Exception: pass
+        );
+        CREATE TABLE IF NOT EXISTS session_waiting (
+            user_id INTEGER PRIMARY KEY, seq INTEGER, gender TEXT, age TEXT, region TEXT, pref_age TEXT, pref_region TEXT
+        );
+        CREATE TABLE IF NOT EXISTS session_chats (user_id INTEGER PRIMARY KEY, partner_id INTEGER);
+        CREATE TABLE IF NOT EXISTS session_invites (invitee_id INTEGER PRIMARY KEY, inviter_id INTEGER);
+        CREATE TABLE IF NOT EXISTS session_games (user_id INTEGER PRIMARY KEY, game TEXT);
+        CREATE TABLE IF NOT EXISTS ledger (
+            id INTEGER PRIMARY KEY, user_id INTEGER, kind TEXT, amount INTEGER, balance INTEGER, ref TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP, reputation REAL
+        );
+        CREATE INDEX IF NOT EXISTS ledger_user ON ledger (user_id, id);
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY, text TEXT, status TEXT DEFAULT 'running', last_user_id INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            pending TEXT
+        );''')
+    storage.add_columns("users", {"pref_age": "TEXT", "pref_region": "TEXT", "blocked": "INTEGER DEFAULT 0"})
+    print("Database setup complete.")
+
+# --- PROFILE CACHE ---
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "50000"))
+PROFILE_FLUSH_INTERVAL = float(os.environ.get("PROFILE_FLUSH_INTERVAL", "5"))
+WRITE_BEHIND_FIELDS = ("total_chats",)  # points and ratings belong to the ledger and are never flushed from here
+# With Redis session state several bot processes share one users table, and a per-process copy of a row would
+# hide the other processes' profile changes from matching, so there every read and write goes to SQLite.
+PROFILE_CACHE_SHARED = os.environ.get("STATE_BACKEND") == "redis"
+
+class ProfileCache:
+    """Bounded LRU of user rows keyed by user_id, in front of the users table.
+    Counter fields (WRITE_BEHIND_FIELDS) are changed in memory and the change is kept as a per-user
+    delta; flush() adds all pending deltas in one executemany batch (`field = field + ?`), so it never
+    overwrites a count another writer has moved meanwhile. Dirty rows pushed out by the LRU wait in
+    `_evicted` until a flush has committed them, and loads look there before the database, so neither
+    eviction nor a load racing the flush can drop an update. A `shared` cache keeps no rows at all:
+    reads hit the table and increments are applied to it directly, so nothing is ever pending."""
+    def __init__(self, max_size, shared=False):
+        self.max_size, self.shared, self._rows, self._dirty, self._evicted, self._flushing = max_size, shared, OrderedDict(), {}, {}, set()
+        self.hits = self.misses = self.flushed_rows = 0
+    async def _load(self, user_id):
+        if self.shared:
+            self.misses += 1; user_data = await storage.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            return dict(user_data) if user_data else None
+        row = self._rows.get(user_id)
+        if row is not None: self._rows.move_to_end(user_id); self.hits += 1; return row
+        row = self._evicted.pop(user_id, None)
+        if row is None:
+            self.misses += 1
+            user_data = await storage.fetchone("SELECT * FROM users WHERE user_id = ?", (user_id,))
+            if user_data is None: return None
+            row = self._rows.get(user_id) or self._evicted.pop(user_id, None) or dict(user_data)  # a concurrent load may have won
+        else: self.hits += 1
+        self._rows[user_id] = row; self._rows.move_to_end(user_id)
+        while len(self._rows) > self.max_size:
+            old_id, old_row = self._rows.popitem(last=False)
+            if old_id in self._dirty or old_id in self._flushing: self._evicted[old_id] = old_row
+        return row
+    async def get(self, user_id):
+        row = await self._load(user_id)
+        return dict(row) if row else None
+    async def set(self, user_id, field, value):
+        if field not in WRITE_BEHIND_FIELDS or self.shared:
+            await storage.execute(f"UPDATE users SET {field} = ? WHERE user_id = ?", (value, user_id))
+            self.refresh(user_id, **{field: value}); return
+        row = await self._load(user_id)
+        if row is not None: await self.increment(user_id, field, value - row[field])
+    @staticmethod
+    def _add(conn, user_id, field, amount):
+        row = conn.execute(f"UPDATE users SET {field} = {field} + ? WHERE user_id = ? RETURNING {field}", (amount, user_id)).fetchone()
+        return row[0] if row else None
+    async def increment(self, user_id, field, amount=1):
+        if self.shared: return await storage.transact(self._add, user_id, field, amount)
+        row = await self._load(user_id)
+        if row is None: return None
+        row[field] += amount; deltas = self._dirty.setdefault(user_id, {}); deltas[field] = deltas.get(field, 0) + amount
+        return row[field]
+    def pending(self, user_id, field):
+        """The part of a write-behind counter not flushed yet (a flush already running commits before any later write)."""
+        return self._dirty.get(user_id, {}).get(field, 0)
+    def refresh(self, user_id, **fields):
+        """Overwrite fields the database already holds (ledger results) in a cached row, without marking it dirty."""
+        row = self._rows.get(user_id) or self._evicted.get(user_id)
+        if row is not None: row.update(fields)
+    async def flush(self):
+        if not self._dirty: return 0
+        dirty, self._dirty = self._dirty, {}; self._flushing = set(dirty)
+        batch = [tuple(deltas.get(f, 0) for f in WRITE_BEHIND_FIELDS) + (user_id,) for user_id, deltas in dirty.items()]
+        try: await storage.executemany(f"UPDATE users SET {', '.join(f'{f} = {f} + ?' for f in WRITE_BEHIND_FIELDS)} WHERE user_id = ?", batch)
+        except Exception as e:
+            SWALLOWED_ERRORS.inc("profile_flush"); print(f"Profile flush failed, will retry: {e}")
+            for user_id, deltas in dirty.items():  # merge back into whatever accumulated meanwhile
+                pending = self._dirty.setdefault(user_id, {})
+                for f, amount in deltas.items(): pending[f] = pending.get(f, 0) + amount
+            self._flushing = set(); return 0
+        self._flushing = set()
+        for user_id in dirty:  # committed now; rows dirtied again meanwhile wait for the next flush
+            if user_id not in self._dirty: self._evicted.pop(user_id, None)
+        self.flushed_rows += len(batch); return len(batch)
+    async def run_flusher(self, interval):
+        while True:
+            await asyncio.sleep(interval); await self.flush()
+    def stats(self):
+        return {"size": len(self._rows), "dirty": len(self._dirty), "hits": self.hits, "misses": self.misses, "flushed_rows": self.flushed_rows}
+
+profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_SHARED)
+async def get_user(user_id): return await profile_cache.get(user_id)
+async def add_user(user_id, first_name):
+    return await storage.execute("INSERT OR IGNORE INTO users (user_id, first_name, points) VALUES (?, ?, 5)", (user_id, first_name)) == 1
+async def update_user(user_id, field, value): await profile_cache.set(user_id, field, value)
+async def increment_user(user_id, field, amount=1): return await profile_cache.increment(user_id, field, amount)
+
+# --- POINTS LEDGER ---
+class Ledger:
+    """Points and ratings. Each operation is one transaction on the writer thread: a guarded
+    UPDATE ... RETURNING checks and changes the balance in a single statement, so concurrent presses
+    cannot double-spend or lose a rating, and every change is appended to the `ledger` table.
+    A rating changes positive_ratings and stores the resulting reputation_score in the same statement,
+    so reads never compute the score; the new score is logged in the ledger's `reputation` column.
+    Cached profiles are refreshed from the returned values."""
+    def __init__(self, storage, cache): self.storage, self.cache = storage, cache
+    @staticmethod
+    def _log(conn, user_id, kind, amount, balance, ref=None):
+        conn.execute("INSERT INTO ledger (user_id, kind, amount, balance, ref) VALUES (?, ?, ?, ?, ?)", (user_id, kind, amount, balance, ref))
+    @staticmethod
+    def _log_rating(conn, user_id, reputation, ref):
+        conn.execute("INSERT INTO ledger (user_id, kind, amount, reputation, ref) VALUES (?, 'rating', 1, ?, ?)", (user_id, reputation, ref))
+    @classmethod
+    def _add_points(cls, conn, user_id, amount, kind, ref=None, guard="", guard_params=()):
+        row = conn.execute(f"UPDATE users SET points = points + ? WHERE user_id = ? AND points + ? >= 0{guard} RETURNING points",
+                           (amount, user_id, amount, *guard_params)).fetchone()
+        if row is None: return None
+        cls._log(conn, user_id, kind, amount, row["points"], ref); return row["points"]
+    @classmethod
+    def _spend(cls, conn, user_id, amount, kind):
+        balance = cls._add_points(conn, user_id, -amount, kind)
+        if balance is not None: return True, balance
+        row = conn.execute("SELECT points FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return False, row["points"] if row else None
+    @classmethod
+    def _referral(cls, conn, user_id, referrer_id, amount):
+        referrer_balance = cls._add_points(conn, referrer_id, amount, "referral", str(user_id))
+        if referrer_balance is None: return None
+        return cls._add_points(conn, user_id, amount, "referral", str(referrer_id)), referrer_balance
+    @classmethod
+    def _redeem(cls, conn, user_id, code, amount):
+        balance = cls._add_points(conn, user_id, amount, "promo", code, " AND NOT EXISTS (SELECT 1 FROM redeemed_codes WHERE user_id = ? AND code = ?)", (user_id, code))
+        if balance is not None: conn.execute("INSERT INTO redeemed_codes (user_id, code) VALUES (?, ?)", (user_id, code))
+        return balance
+    @classmethod
+    def _rate(cls, conn, user_id, rater_id, unflushed_chats):
+        row = conn.execute("""UPDATE users SET positive_ratings = positive_ratings + 1, reputation_score = MIN(10.0,
+                                  CASE WHEN total_chats + :pending > 0 THEN (positive_ratings + 1) * 3.0 / (total_chats + :pending) + 7 ELSE 7.0 END)
+                              WHERE user_id = :user RETURNING positive_ratings, reputation_score""", {"pending": unflushed_chats, "user": user_id}).fetchone()
+        if row is None: return None
+        cls._log_rating(conn, user_id, row["reputation_score"], str(rater_id)); return row["positive_ratings"], float(row["reputation_score"])
+
+    async def spend(self, user_id, amount, kind):
+        """Take `amount` points if the balance covers it. Returns (spent, balance)."""
+        spent, balance = await self.storage.transact(self._spend, user_id, amount, kind)
+        if balance is not None: self.cache.refresh(user_id, points=balance)
+        return spent, balance
+    async def grant(self, user_id, amount, kind, ref=None):
+        balance = await self.storage.transact(self._add_points, user_id, amount, kind, ref)
+        if balance is not None: self.cache.refresh(user_id, points=balance)
+        return balance
+    async def referral(self, user_id, referrer_id, amount):
+        """Credit both sides of a referral together; None if the referrer is not a user."""
+        balances = await self.storage.transact(self._referral, user_id, referrer_id, amount)
+        if balances is not None: self.cache.refresh(user_id, points=balances[0]); self.cache.refresh(referrer_id, points=balances[1])
+        return balances
+    async def redeem(self, user_id, code, amount):
+        """Credit a promo code once per user. Returns the new balance, or None if it was already used."""
+        balance = await self.storage.transact(self._redeem, user_id, code, amount)
+        if balance is not None: self.cache.refresh(user_id, points=balance)
+        return balance
+    async def rate(self, user_id, rater_id):
+        # total_chats is write-behind: add the chats this process counted but hasn't flushed yet
+        result = await self.storage.transact(self._rate, user_id, rater_id, self.cache.pending(user_id, "total_chats"))
+        if result is not None: self.cache.refresh(user_id, positive_ratings=result[0], reputation_score=result[1])
+        return result
+
+ledger = Ledger(storage, profile_cache)
+
+# --- WEB SERVER ---
+PORT = int(os.environ.get("PORT", "8080"))
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # "polling" or "webhook"
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL; without it the webhook route still serves local POSTs
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Telegram echoes the secret back in a header on every webhook call; the route rejects requests without it,
+# otherwise anyone who guesses the path could post forged updates (an admin /broadcast included)
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    if not WEBHOOK_URL: raise RuntimeError("FATAL: BOT_MODE=webhook without WEBHOOK_URL needs WEBHOOK_SECRET, the secret token the webhook was registered with.")
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)  # we register the webhook ourselves, so a fresh secret per start will do
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+HTTP_MAX_BODY, HTTP_READ_TIMEOUT = 1 << 20, 75  # the timeout covers a whole request (line, headers and body) and keep-alive idling
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+class HttpServer:
+    """Minimal HTTP/1.1 server on asyncio streams, running on the bot's own event loop. Routes map
+    (method, path) to `async handler(headers, body) -> (status, content_type, body)`."""
+    def __init__(self): self.routes, self._server, self._writers = {}, None, set()
+    def route(self, method, path, handler): self.routes[(method, path)] = handler
+    async def _respond(self, writer, status, content_type, body, keep_alive):
+        writer.write(f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body)
+        await writer.drain()
+    @staticmethod
+    async def _read_request(reader):
+        """(method, target, headers, keep_alive, body) of the next request, or None at EOF; body is None if over HTTP_MAX_BODY."""
+        request_line = await reader.readline()
+        if not request_line: return None
+        method, target, version = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":"); headers[name.strip().lower()] = value.strip()
+        keep_alive = version.strip() == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        length = int(headers.get("content-length") or 0)
+        if length > HTTP_MAX_BODY: return method, target, headers, False, None
+        return method, target, headers, keep_alive, await reader.readexactly(length) if length else b""
+    async def _handle(self, reader, writer):
+        self._writers.add(writer)
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), HTTP_READ_TIMEOUT)
+                if request is None: break
+                method, target, headers, keep_alive, body = request
+                if body is None: await self._respond(writer, 413, "text/plain", b"too large", False); break
+                path = target.split("?", 1)[0]; handler = self.routes.get((method, path))
+                if handler is None: status, content_type, payload = (405 if any(p == path for _, p in self.routes) else 404), "text/plain", b""
+                else: status, content_type, payload = await handler(headers, body)
+                await self._respond(writer, status, content_type, payload, keep_alive)
+                if not keep_alive: break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError): pass
+        finally: self._writers.discard(writer); writer.close()
+    async def start(self, host, port): self._server = await asyncio.start_server(self._handle, host, port); return self
+    async def close(self):
+        if self._server is None: return
+        self._server.close()
+        for writer in list(self._writers): writer.close()  # idle keep-alive connections would otherwise hold wait_closed()
+        await self._server.wait_closed(); self._server = None
+
+STATE_GAUGE = metrics.gauge("bot_sessions", "Live session state: waiting users, active pairs, pending invites, running games.", ("kind",))
+WAITING_GAUGE = metrics.gauge("bot_waiting_users", "Users waiting for a partner, by gender (in-process state backends only).", ("gender",))
+OUTBOX_GAUGE = metrics.gauge("bot_outbox", "Outbound dispatcher: queue depth, in-flight calls and cumulative counters.", ("stat",))
+OUTBOX_LATENCY = metrics.gauge("bot_outbox_send_latency_seconds", "Recent enqueue-to-sent latency of outbound calls.", ("priority", "quantile"))
+CACHE_GAUGE = metrics.gauge("bot_profile_cache", "Profile cache size, dirty rows, hits, misses and flushed rows.", ("stat",))
+REAPER_GAUGE = metrics.gauge("bot_reaper", "Sessions watched by the idle reaper and entries in its timer wheel.", ("stat",))
+SUGGESTION_GAUGE = metrics.gauge("bot_suggestions", "TMDb suggestion pool counters.", ("stat",))
+FLOOD_GAUGE = metrics.gauge("bot_flood_guard_users", "Users the flood guard is tracking buckets for.")
+
+@metrics.collector
+async def collect_runtime_metrics():
+    for kind, value in (await state.counts()).items(): STATE_GAUGE.set(value, kind)
+    if isinstance(state, MemoryState):
+        for gender, value in state.matchmaker.sizes().items(): WAITING_GAUGE.set(value, gender)
+    stats = outbox.stats()
+    for stat in ("queued", "in_flight", "chats_queued", "sent", "failed", "dropped", "coalesced", "retry_after", "cancelled"): OUTBOX_GAUGE.set(stats[stat], stat)
+    for priority, samples in (("relay", outbox._latency[PRIORITY_RELAY]), ("other", outbox._latency[PRIORITY_NORMAL]), ("bulk", outbox._latency[PRIORITY_BULK])):
+        for q in (0.5, 0.99): OUTBOX_LATENCY.set(_percentile(samples, q), priority, q)
+    for stat, value in profile_cache.stats().items(): CACHE_GAUGE.set(value, stat)
+    for stat, value in suggestions.counters.items(): SUGGESTION_GAUGE.set(value, stat)
+    REAPER_GAUGE.set(len(reaper), "watched"); REAPER_GAUGE.set(reaper.wheel.count, "wheel_entries")
+    FLOOD_GAUGE.set(len(flood_guard))
+
+def build_web_server(application: Application):
+    server = HttpServer()
+    async def index(headers, body): return 200, "text/plain; charset=utf-8", b"Bot is alive and running!"
+    async def metrics_page(headers, body): return 200, "text/plain; version=0.0.4; charset=utf-8", (await metrics.render()).encode()
+    async def webhook(headers, body):
+        if not secrets.compare_digest(headers.get("x-telegram-bot-api-secret-token", "").encode(), WEBHOOK_SECRET.encode()): return 403, "text/plain", b""
+        try: update = Update.de_json(json.loads(body), application.bot)
+        except Exception: update = None  # bad JSON, or JSON that isn't an Update: de_json fails with whatever the data trips over
+        if update is None: return 400, "text/plain", b""
+        try: application.update_queue.put_nowait(update)
+        except asyncio.QueueFull: return 503, "text/plain", b""  # Telegram redelivers the update later
+        return 200, "text/plain", b"ok"
+    server.route("GET", "/", index); server.route("HEAD", "/", index); server.route("GET", "/metrics", metrics_page)
+    if BOT_MODE == "webhook": server.route("POST", WEBHOOK_PATH, webhook)
+    return server
+
+# --- MATCHMAKING ---
+GENDERS = ("male", "female"); AGE_RANGES = ("18-30", "30-40", "40-50"); REGIONS = ("Asia", "Europe", "Africa", "America")
+
+class _WaitQueue:
+    """One bucket of waiting users: FIFO order in an OrderedDict (user_id -> enqueue seq) plus a
+    dense list with a position index, so pop-oldest, cancel and random picks are all O(1)."""
+    __slots__ = ("order", "items", "pos")
+    def __init__(self): self.order, self.items, self.pos = OrderedDict(), [], {}
+    def __len__(self): return len(self.items)
+    def push(self, user_id, seq): self.order[user_id] = seq; self.pos[user_id] = len(self.items); self.items.append(user_id)
+    def remove(self, user_id):
+        del self.order[user_id]; i = self.pos.pop(user_id); last = self.items.pop()
+        if last != user_id: self.items[i] = last; self.pos[last] = i
+    def head_seq(self): return self.order[next(iter(self.order))]
+    def head(self): return next(iter(self.order))
+
+class Matchmaker:
+    """Waiting users bucketed by (gender, age, region, pref_age, pref_region) with a user -> bucket index.
+    A search only looks at the buckets compatible both ways (the candidate fits my preferences and I fit
+    theirs), which is a bounded number of dict lookups no matter how many users are waiting."""
+    def __init__(self): self._queues, self._where, self._seq = {}, {}, 0
+    def __contains__(self, user_id): return user_id in self._where
+    def __len__(self): return len(self._where)
+    def sizes(self):
+        sizes = dict.fromkeys(GENDERS, 0)
+        for key, queue in self._queues.items(): sizes[key[0]] = sizes.get(key[0], 0) + len(queue)
+        return sizes
+    @staticmethod
+    def _key(profile): return (profile["gender"], profile["age"], profile["region"], profile.get("pref_age"), profile.get("pref_region"))
+    def enqueue(self, user_id, profile): return self.enqueue_key(user_id, self._key(profile))
+    def enqueue_key(self, user_id, key, seq=None):
+        self.cancel(user_id); queue = self._queues.get(key)
+        if queue is None: queue = self._queues[key] = _WaitQueue()
+        self._seq = max(self._seq + 1, seq or 0); queue.push(user_id, self._seq); self._where[user_id] = key
+        return self._seq
+    def entry(self, user_id):
+        key = self._where.get(user_id)
+        return (key, self._queues[key].order[user_id]) if key is not None else None
+    def entries(self):
+        """All waiting users as (seq, user_id, key), oldest first."""
+        return sorted((seq, user_id, key) for key, queue in self._queues.items() for user_id, seq in queue.order.items())
+    def cancel(self, user_id):
+        key = self._where.pop(user_id, None)
+        if key is None: return False
+        queue = self._queues[key]; queue.remove(user_id)
+        if not queue: del self._queues[key]
+        return True
+    @staticmethod
+    def compatible_keys(profile, genders):
+        pref_age, pref_region = profile.get("pref_age"), profile.get("pref_region")
+        ages, regions = (pref_age,) if pref_age else AGE_RANGES, (pref_region,) if pref_region else REGIONS
+        their_ages, their_regions = (None, profile["age"]), (None, profile["region"])
+        for gender in genders:
+            for age in ages:
+                for region in regions:
+                    for their_age in their_ages:
+                        for their_region in their_regions: yield (gender, age, region, their_age, their_region)
+    def _compatible(self, profile, genders):
+        for key in self.compatible_keys(profile, genders):
+            queue = self._queues.get(key)
+            if queue: yield queue
+    def pop_oldest(self, profile, genders):
+        queues = list(self._compatible(profile, genders))
+        if not queues: return None
+        partner_id = min(queues, key=_WaitQueue.head_seq).head(); self.cancel(partner_id); return partner_id
+    def pop_random(self, profile, genders):
+        queues = list(self._compatible(profile, genders)); total = sum(len(q) for q in queues)
+        if not total: return None
+        i = random.randrange(total)
+        for queue in queues:
+            if i < len(queue): partner_id = queue.items[i]; self.cancel(partner_id); return partner_id
+            i -= len(queue)
 
 # --- BOT STATE & KEYBOARDS ---
-waiting_pool = {"male": [], "female": [], "any": []}; active_chats = {}; active_games = {}; pending_invites = {}; lock = asyncio.Lock()
-def main_menu_keyboard():
-    return ReplyKeyboardMarkup([
-        ["🎮 Random Chat", "🔎 Search by Gender"],
-        ["🛑 End Chat", "Next ⏭️"],
-        ["👤 My Profile", "ℹ️ Help"]
-    ], resize_keyboard=True)
-def gender_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("I'm a Male 👨", callback_data="gender_male"), InlineKeyboardButton("I'm a Female 👩", callback_data="gender_female")]])
-def age_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("18-30", callback_data="age_18-30")], [InlineKeyboardButton("30-40", callback_data="age_30-40")], [InlineKeyboardButton("40-50", callback_data="age_40-50")]])
-def region_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("Asia", callback_data="region_Asia")], [InlineKeyboardButton("Europe", callback_data="region_Europe")], [InlineKeyboardButton("Africa", callback_data="region_Africa")], [InlineKeyboardButton("America", callback_data="region_America")]])
-def post_chat_keyboard(partner_id): return InlineKeyboardMarkup([[InlineKeyboardButton("Polite 👍", callback_data=f"rate_polite_{partner_id}"), InlineKeyboardButton("Respectful 👍", callback_data=f"rate_respect_{partner_id}")], [InlineKeyboardButton("Report 🚩", callback_data=f"report_{partner_id}")]])
-def in_chat_actions_keyboard(): return InlineKeyboardMarkup([[InlineKeyboardButton("🎲 Suggest a Game of X-O", callback_data="suggest_xo")], [InlineKeyboardButton("🎬 Suggest a Movie", callback_data="suggest_movie")], [InlineKeyboardButton("🎌 Suggest an Anime", callback_data="suggest_anime")]])
-def game_invite_keyboard(inviter_id): return InlineKeyboardMarkup([[InlineKeyboardButton("✅ Accept", callback_data=f"xo_accept_{inviter_id}"), InlineKeyboardButton("❌ Decline", callback_data=f"xo_decline_{inviter_id}")]])
+# Session state (waiting users, pairs, invites, games) lives behind `state`, see SESSION STATE below; each of its
+# operations is atomic. The striped locks just serialize each user's own flows (e.g. Next spam); matching and
+# teardown never hold them across Telegram calls, and a flow only ever holds its own user's stripe.
+USER_LOCK_STRIPES = 1024; _user_locks = [asyncio.Lock() for _ in range(USER_LOCK_STRIPES)]
+@asynccontextmanager
+async def user_lock(user_id, site):
+    lock, started = _user_locks[user_id % USER_LOCK_STRIPES], time.perf_counter()
+    await lock.acquire(); acquired = time.perf_counter(); LOCK_WAIT_SECONDS.observe(acquired - started, site)
+    try: yield
+    finally: lock.release(); LOCK_HOLD_SECONDS.observe(time.perf_counter() - acquired, site)
+
+# Callback data is packed as "~" + base64(struct ">Bq": op, arg), 13 characters for any button. decode_callback()
+# turns it (or the older "prefix_value" strings still sitting in users' chats) into (op, arg) once, and callback_handler
+# dispatches on op through CALLBACK_ROUTES. Choice buttons carry an index into GENDERS/AGE_RANGES/REGIONS, -1 for "any".
+(CB_SUGGEST_MOVIE, CB_SUGGEST_ANIME, CB_SUGGEST_XO, CB_XO_ACCEPT, CB_XO_DECLINE, CB_XO_MOVE, CB_GENDER, CB_AGE, CB_REGION,
+ CB_PREF_AGE, CB_PREF_REGION, CB_RATE_POLITE, CB_RATE_RESPECT, CB_REPORT) = range(1, 15)
+PACKED_CALLBACK = struct.Struct(">Bq")
+def pack_callback(op, arg=0): return "~" + base64.b64encode(PACKED_CALLBACK.pack(op, arg)).decode()
+LEGACY_CALLBACKS = {"suggest_movie": (CB_SUGGEST_MOVIE, 0), "suggest_anime": (CB_SUGGEST_ANIME, 0), "suggest_xo": (CB_SUGGEST_XO, 0)}
+LEGACY_PREFIXES = {"xo_accept": (CB_XO_ACCEPT, int), "xo_decline": (CB_XO_DECLINE, int), "xo_move": (CB_XO_MOVE, int),
+                   "gender": (CB_GENDER, GENDERS.index), "age": (CB_AGE, AGE_RANGES.index), "region": (CB_REGION, REGIONS.index),
+                   "rate_polite": (CB_RATE_POLITE, int), "rate_respect": (CB_RATE_RESPECT, int), "report": (CB_REPORT, int)}
+@lru_cache(maxsize=8192)
+def decode_callback(data):
+    """(op, arg) for packed or legacy callback data, or None if it isn't one of ours."""
+    try:
+        if data.startswith("~"): return PACKED_CALLBACK.unpack(binascii.a2b_base64(data[1:]))
+        if data in LEGACY_CALLBACKS: return LEGACY_CALLBACKS[data]
+        prefix, _, value = data.rpartition("_"); op, parse = LEGACY_PREFIXES[prefix]; return op, parse(value)
+    except (KeyError, ValueError, struct.error, binascii.Error): return None
+
+# Keyboards are immutable in python-telegram-bot, so the static ones are built once and shared by every reply.
+def _button(text, op, arg=0): return InlineKeyboardButton(text, callback_data=pack_callback(op, arg))
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    ["🎮 Random Chat", "🔎 Search by Gender"],
+    ["🛑 End Chat", "Next ⏭️"],
+    ["👤 My Profile", "ℹ️ Help"]
+], resize_keyboard=True)
+GENDER_KEYBOARD = InlineKeyboardMarkup([[_button("I'm a Male 👨", CB_GENDER, GENDERS.index("male")), _button("I'm a Female 👩", CB_GENDER, GENDERS.index("female"))]])
+AGE_KEYBOARD = InlineKeyboardMarkup([[_button(a, CB_AGE, i)] for i, a in enumerate(AGE_RANGES)])
+REGION_KEYBOARD = InlineKeyboardMarkup([[_button(r, CB_REGION, i)] for i, r in enumerate(REGIONS)])
+PREF_AGE_KEYBOARD = InlineKeyboardMarkup([[_button(a, CB_PREF_AGE, i)] for i, a in enumerate(AGE_RANGES)] + [[_button("Any age", CB_PREF_AGE, -1)]])
+PREF_REGION_KEYBOARD = InlineKeyboardMarkup([[_button(r, CB_PREF_REGION, i)] for i, r in enumerate(REGIONS)] + [[_button("Any region", CB_PREF_REGION, -1)]])
+IN_CHAT_ACTIONS_KEYBOARD = InlineKeyboardMarkup([[_button("🎲 Suggest a Game of X-O", CB_SUGGEST_XO)], [_button("🎬 Suggest a Movie", CB_SUGGEST_MOVIE)], [_button("🎌 Suggest an Anime", CB_SUGGEST_ANIME)]])
+def post_chat_keyboard(partner_id): return InlineKeyboardMarkup([[_button("Polite 👍", CB_RATE_POLITE, partner_id), _button("Respectful 👍", CB_RATE_RESPECT, partner_id)], [_button("Report 🚩", CB_REPORT, partner_id)]])
+def game_invite_keyboard(inviter_id): return InlineKeyboardMarkup([[_button("✅ Accept", CB_XO_ACCEPT, inviter_id), _button("❌ Decline", CB_XO_DECLINE, inviter_id)]])
+@lru_cache(maxsize=4096)
+def board_keyboard(board): return InlineKeyboardMarkup([[_button(board[i] if board[i] != " " else "⬜️", CB_XO_MOVE, i) for i in range(j, j + 3)] for j in range(0, 9, 3)])
 
 # --- GAME LOGIC (X-O) ---
 class XO_Game:
     def __init__(self, p1, p2): self.p1, self.p2, self.board, self.turn, self.winner, self.sym, self.msgs = p1, p2, [" "] * 9, p1, None, {p1: "🍓", p2: "🥝"}, {}
-    def get_keyboard(self): return InlineKeyboardMarkup([[InlineKeyboardButton(self.board[i] if self.board[i] != " " else "⬜️", callback_data=f"xo_move_{i}") for i in range(j, j + 3)] for j in range(0, 9, 3)])
+    def get_keyboard(self): return board_keyboard(tuple(self.board))
     def make_move(self, pos, p_id):
         if self.winner or self.board[pos] != " " or p_id != self.turn: return False
         self.board[pos] = self.sym[p_id]
@@ -108,305 +607,1216 @@ class XO_Game:
     def get_status(self):
         if self.winner: return f"Game over! Winner: {self.sym[self.winner]} 🎉" if self.winner != "tie" else "It's a tie! 🤝"
         return f"It's {self.sym[self.turn]}'s turn."
+    def to_dict(self): return {"p1": self.p1, "p2": self.p2, "board": self.board, "turn": self.turn, "winner": self.winner, "msgs": self.msgs}
+    @classmethod
+    def from_dict(cls, data):
+        game = cls(data["p1"], data["p2"]); game.board, game.turn, game.winner = list(data["board"]), data["turn"], data["winner"]
+        game.msgs = {int(p_id): msg_id for p_id, msg_id in data["msgs"].items()}; return game
 
-# --- TMDb API Function ---
-def get_tmdb_suggestion(suggestion_type: str):
-    if not TMDB_API_KEY: return None, "Suggestion feature is currently disabled."
-    base_url = "https://api.themoviedb.org/3"
-    if suggestion_type == "movie":
-        endpoint = "/movie/popular"
-        params = {'api_key': TMDB_API_KEY, 'language': 'en-US', 'page': random.randint(1, 50 )}
-    else:
-        endpoint = "/discover/tv"
-        params = {'api_key': TMDB_API_KEY, 'language': 'en-US', 'with_keywords': '210024|287501', 'with_origin_country': 'JP', 'page': random.randint(1, 20)}
-    try:
-        response = requests.get(base_url + endpoint, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        if not data.get('results'): return None, "Could not find a suggestion right now."
-        item = random.choice(data['results'])
+# --- SESSION STATE ---
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory")  # "memory", "sqlite" or "redis"
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.environ.get("REDIS_PREFIX", "anonchat:")
+
+class MemoryState:
+    """Session state in process memory: the matchmaker plus plain dicts (user -> partner, invitee -> inviter,
+    user -> game). Method bodies never await, so every operation is atomic on the event loop."""
+    def __init__(self): self.matchmaker, self.chats, self.invites, self.games = Matchmaker(), {}, {}, {}
+    async def load(self): pass
+    async def close(self): pass
+    async def partner(self, user_id): return self.chats.get(user_id)
+    async def pair_or_enqueue(self, user_id, profile, search_preference):
+        if user_id in self.chats: return "in_chat", None
+        matchmaker = self.matchmaker; matchmaker.cancel(user_id)
+        if search_preference == "gender": partner_id = matchmaker.pop_oldest(profile, ("female",) if profile["gender"] == "male" else ("male",))
+        else: partner_id = matchmaker.pop_random(profile, GENDERS)
+        if partner_id is None: matchmaker.enqueue(user_id, profile); return "waiting", None
+        self.chats[user_id], self.chats[partner_id] = partner_id, user_id
+        return "matched", partner_id
+    async def end(self, user_id):
+        if self.matchmaker.cancel(user_id): return "search_cancelled", None
+        partner_id = self.chats.pop(user_id, None)
+        if partner_id is None: return "not_in_chat", None
+        self.chats.pop(partner_id, None)
+        self.games.pop(user_id, None); self.games.pop(partner_id, None)
+        self.invites.pop(partner_id, None)
+        if self.invites.get(user_id) == partner_id: del self.invites[user_id]
+        return "chat_ended", partner_id
+    async def cancel_search(self, user_id): return self.matchmaker.cancel(user_id)
+    async def invite(self, inviter_id, invitee_id):
+        if self.chats.get(inviter_id) != invitee_id: return False
+        self.invites[invitee_id] = inviter_id; return True
+    async def take_invite(self, invitee_id, inviter_id):
+        if self.invites.get(invitee_id) != inviter_id: return False
+        del self.invites[invitee_id]; return True
+    async def get_game(self, user_id): return self.games.get(user_id)
+    async def save_game(self, game): self.games[game.p1] = self.games[game.p2] = game
+    async def update_game(self, user_id, change):
+        """Apply change(game) to user_id's game atomically; returns (game, whether change reported a change)."""
+        game = self.games.get(user_id)
+        return (game, bool(change(game))) if game else (None, False)
+    async def end_game(self, game):
+        for p_id in (game.p1, game.p2):
+            if self.games.get(p_id) is game: del self.games[p_id]
+    async def counts(self): return {"waiting": len(self.matchmaker), "pairs": len(self.chats) // 2, "invites": len(self.invites), "games": len(self.games) // 2}
+    def snapshot(self):
+        games = {id(game): game for game in self.games.values()}
+        return {"waiting": [(seq, user_id, list(key)) for seq, user_id, key in self.matchmaker.entries()], "chats": dict(self.chats),
+                "invites": dict(self.invites), "games": [game.to_dict() for game in games.values()]}
+    def restore(self, snapshot):
+        self.__init__()
+        for seq, user_id, key in snapshot["waiting"]: self.matchmaker.enqueue_key(user_id, tuple(key), seq)
+        self.chats.update(snapshot["chats"]); self.invites.update(snapshot["invites"])
+        for data in snapshot["games"]: game = XO_Game.from_dict(data); self.games[game.p1] = self.games[game.p2] = game
+
+class SqliteState(MemoryState):
+    """MemoryState journaled to the session_* tables. Every mutation queues its rows on the storage writer
+    (one transaction, in call order) without waiting, and load() rebuilds the whole state on startup."""
+    def _journal(self, *statements): storage.submit(list(statements))
+    def _waiting_row(self, user_id):
+        key, seq = self.matchmaker.entry(user_id)
+        return ("INSERT OR REPLACE INTO session_waiting VALUES (?, ?, ?, ?, ?, ?, ?)", (user_id, seq) + key)
+    async def load(self):
+        snapshot = {"waiting": [(r["seq"], r["user_id"], (r["gender"], r["age"], r["region"], r["pref_age"], r["pref_region"]))
+                                for r in await storage.fetchall("SELECT * FROM session_waiting ORDER BY seq")],
+                    "chats": {r["user_id"]: r["partner_id"] for r in await storage.fetchall("SELECT * FROM session_chats")},
+                    "invites": {r["invitee_id"]: r["inviter_id"] for r in await storage.fetchall("SELECT * FROM session_invites")},
+                    "games": list({r["game"]: json.loads(r["game"]) for r in await storage.fetchall("SELECT * FROM session_games")}.values())}
+        self.restore(snapshot)
+        print(f"Restored session state: {await self.counts()}")
+    async def pair_or_enqueue(self, user_id, profile, search_preference):
+        result, partner_id = await super().pair_or_enqueue(user_id, profile, search_preference)
+        if result == "matched":
+            self._journal(("DELETE FROM session_waiting WHERE user_id IN (?, ?)", (user_id, partner_id)),
+                          ("INSERT OR REPLACE INTO session_chats VALUES (?, ?), (?, ?)", (user_id, partner_id, partner_id, user_id)))
+        elif result == "waiting": self._journal(self._waiting_row(user_id))
+        return result, partner_id
+    async def end(self, user_id):
+        result, partner_id = await super().end(user_id)
+        if result == "search_cancelled": self._journal(("DELETE FROM session_waiting WHERE user_id = ?", (user_id,)))
+        elif result == "chat_ended":
+            pair = (user_id, partner_id)
+            self._journal(("DELETE FROM session_chats WHERE user_id IN (?, ?)", pair), ("DELETE FROM session_games WHERE user_id IN (?, ?)", pair),
+                          ("DELETE FROM session_invites WHERE invitee_id = ? OR (invitee_id = ? AND inviter_id = ?)", (partner_id, user_id, partner_id)))
+        return result, partner_id
+    async def cancel_search(self, user_id):
+        if not await super().cancel_search(user_id): return False
+        self._journal(("DELETE FROM session_waiting WHERE user_id = ?", (user_id,))); return True
+    async def invite(self, inviter_id, invitee_id):
+        if not await super().invite(inviter_id, invitee_id): return False
+        self._journal(("INSERT OR REPLACE INTO session_invites VALUES (?, ?)", (invitee_id, inviter_id))); return True
+    async def take_invite(self, invitee_id, inviter_id):
+        if not await super().take_invite(invitee_id, inviter_id): return False
+        self._journal(("DELETE FROM session_invites WHERE invitee_id = ?", (invitee_id,))); return True
+    async def save_game(self, game):
+        await super().save_game(game); data = json.dumps(game.to_dict())
+        self._journal(("INSERT OR REPLACE INTO session_games VALUES (?, ?), (?, ?)", (game.p1, data, game.p2, data)))
+    async def update_game(self, user_id, change):
+        game, changed = await super().update_game(user_id, change)
+        if changed: data = json.dumps(game.to_dict()); self._journal(("INSERT OR REPLACE INTO session_games VALUES (?, ?), (?, ?)", (game.p1, data, game.p2, data)))
+        return game, changed
+    async def end_game(self, game):
+        await super().end_game(game); self._journal(("DELETE FROM session_games WHERE user_id IN (?, ?)", (game.p1, game.p2)))
+
+class RedisState:
+    """Session state in Redis, shared by every bot process using the same REDIS_URL and prefix. Matching,
+    ending a chat and taking an invite are Lua scripts, so each runs atomically on the server; game updates
+    are a compare-and-set script retried until no other process wrote the game in between. Waiting
+    users sit in one sorted set per matchmaking bucket, scored by a global enqueue counter."""
+    MATCH = """
+local p = ARGV[1]; local uid = ARGV[2]
+if redis.call('HEXISTS', p .. 'chats', uid) == 1 then return {'in_chat'} end
+local own = redis.call('HGET', p .. 'waiting', uid)
+if own then redis.call('ZREM', own, uid); redis.call('HDEL', p .. 'waiting', uid) end
+local partner = nil; local n = #KEYS - 1
+if ARGV[3] == 'oldest' then
+  local best = nil
+  for i = 1, n do
+    local head = redis.call('ZRANGE', KEYS[i], 0, 0, 'WITHSCORES')
+    if head[1] and (best == nil or tonumber(head[2]) < best) then best = tonumber(head[2]); partner = head[1] end
+  end
+else
+  local sizes = {}; local total = 0
+  for i = 1, n do sizes[i] = redis.call('ZCARD', KEYS[i]); total = total + sizes[i] end
+  if total > 0 then
+    local r = math.floor(tonumber(ARGV[4]) * total)
+    for i = 1, n do
+      if r < sizes[i] then partner = redis.call('ZRANGE', KEYS[i], r, r)[1]; break end
+      r = r - sizes[i]
+    end
+  end
+end
+if partner then
+  redis.call('ZREM', redis.call('HGET', p .. 'waiting', partner), partner); redis.call('HDEL', p .. 'waiting', partner)
+  redis.call('HSET', p .. 'chats', uid, partner); redis.call('HSET', p .. 'chats', partner, uid)
+  return {'matched', partner}
+end
+redis.call('ZADD', KEYS[#KEYS], redis.call('INCR', p .. 'seq'), uid); redis.call('HSET', p .. 'waiting', uid, KEYS[#KEYS])
+return {'waiting'}
+"""
+    END = """
+local p = ARGV[1]; local uid = ARGV[2]
+local own = redis.call('HGET', p .. 'waiting', uid)
+if own then redis.call('ZREM', own, uid); redis.call('HDEL', p .. 'waiting', uid); return {'search_cancelled'} end
+if ARGV[3] == 'search' then return {'not_waiting'} end
+local partner = redis.call('HGET', p .. 'chats', uid)
+if not partner then return {'not_in_chat'} end
+redis.call('HDEL', p .. 'chats', uid, partner); redis.call('HDEL', p .. 'games', uid, partner); redis.call('HDEL', p .. 'invites', partner)
+if redis.call('HGET', p .. 'invites', uid) == partner then redis.call('HDEL', p .. 'invites', uid) end
+return {'chat_ended', partner}
+"""
+    INVITE = """
+if redis.call('HGET', ARGV[1] .. 'chats', ARGV[2]) ~= ARGV[3] then return 0 end
+redis.call('HSET', ARGV[1] .. 'invites', ARGV[3], ARGV[2]); return 1
+"""
+    TAKE_INVITE = """
+if redis.call('HGET', ARGV[1] .. 'invites', ARGV[2]) ~= ARGV[3] then return 0 end
+redis.call('HDEL', ARGV[1] .. 'invites', ARGV[2]); return 1
+"""
+    SET_GAME = """
+if redis.call('HGET', ARGV[1] .. 'games', ARGV[2]) ~= ARGV[5] then return 0 end
+redis.call('HSET', ARGV[1] .. 'games', ARGV[3], ARGV[6], ARGV[4], ARGV[6]); return 1
+"""
+    def __init__(self, url, prefix):
+        if aioredis is None: raise RuntimeError("FATAL: STATE_BACKEND=redis needs the 'redis' package (pip install redis).")
+        self.prefix, self.redis = prefix, aioredis.from_url(url, decode_responses=True)
+        self._match, self._end = self.redis.register_script(self.MATCH), self.redis.register_script(self.END)
+        self._invite, self._take_invite = self.redis.register_script(self.INVITE), self.redis.register_script(self.TAKE_INVITE)
+        self._set_game = self.redis.register_script(self.SET_GAME)
+    def _bucket(self, key): return self.prefix + "q:" + "|".join(part or "" for part in key)
+    def _active_key(self, kind, key): return f"{self.prefix}active:{kind}:" + ("|".join(map(str, key)) if isinstance(key, tuple) else str(key))
+    def mark_active(self, kind, key, ttl):
+        """Record (wall-clock) activity on a session for every process's reaper; fire-and-forget, and it expires on its own."""
+        task = asyncio.create_task(self.redis.set(self._active_key(kind, key), time.time(), ex=max(1, int(ttl))))
+        task.add_done_callback(lambda task: task.cancelled() or task.exception() is None or SWALLOWED_ERRORS.inc("session_activity"))
+    async def last_active(self, kind, key):
+        value = await self.redis.get(self._active_key(kind, key)); return float(value) if value else None
+    async def load(self): await self.redis.ping(); print(f"Connected to Redis session state: {await self.counts()}")
+    async def close(self): await self.redis.aclose() if hasattr(self.redis, "aclose") else await self.redis.close()
+    async def partner(self, user_id):
+        partner_id = await self.redis.hget(self.prefix + "chats", user_id); return int(partner_id) if partner_id else None
+    async def pair_or_enqueue(self, user_id, profile, search_preference):
+        genders = (("female",) if profile["gender"] == "male" else ("male",)) if search_preference == "gender" else GENDERS
+        keys = [self._bucket(key) for key in Matchmaker.compatible_keys(profile, genders)] + [self._bucket(Matchmaker._key(profile))]
+        reply = await self._match(keys=keys, args=[self.prefix, user_id, "oldest" if search_preference == "gender" else "random", random.random()])
+        return reply[0], int(reply[1]) if len(reply) > 1 else None
+    async def end(self, user_id):
+        reply = await self._end(args=[self.prefix, user_id]); return reply[0], int(reply[1]) if len(reply) > 1 else None
+    async def cancel_search(self, user_id): return (await self._end(args=[self.prefix, user_id, "search"]))[0] == "search_cancelled"
+    async def invite(self, inviter_id, invitee_id): return bool(await self._invite(args=[self.prefix, inviter_id, invitee_id]))
+    async def take_invite(self, invitee_id, inviter_id): return bool(await self._take_invite(args=[self.prefix, invitee_id, inviter_id]))
+    async def get_game(self, user_id):
+        data = await self.redis.hget(self.prefix + "games", user_id); return XO_Game.from_dict(json.loads(data)) if data else None
+    async def save_game(self, game):
+        data = json.dumps(game.to_dict()); await self.redis.hset(self.prefix + "games", mapping={game.p1: data, game.p2: data})
+    async def update_game(self, user_id, change):
+        # The XO rules stay in XO_Game: read, apply in Python, and write back only if the stored game is unchanged
+        while True:
+            data = await self.redis.hget(self.prefix + "games", user_id)
+            if not data: return None, False
+            game = XO_Game.from_dict(json.loads(data))
+            if not change(game): return game, False
+            if await self._set_game(args=[self.prefix, user_id, game.p1, game.p2, data, json.dumps(game.to_dict())]): return game, True
+    async def end_game(self, game): await self.redis.hdel(self.prefix + "games", game.p1, game.p2)
+    async def counts(self):
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for name in ("waiting", "chats", "invites", "games"): pipe.hlen(self.prefix + name)
+            waiting, chats, invites, games = await pipe.execute()
+        return {"waiting": waiting, "pairs": chats // 2, "invites": invites, "games": games // 2}
+
+def build_state(backend):
+    if backend == "sqlite": return SqliteState()
+    if backend == "redis": return RedisState(REDIS_URL, REDIS_PREFIX)
+    return MemoryState()
+
+state = build_state(STATE_BACKEND)
+
+# --- IDLE REAPER ---
+IDLE_TIMEOUTS = {"search": float(os.environ.get("IDLE_SEARCH_SECONDS", "1800")), "chat": float(os.environ.get("IDLE_CHAT_SECONDS", "3600")),
+                 "invite": float(os.environ.get("IDLE_INVITE_SECONDS", "300")), "game": float(os.environ.get("IDLE_GAME_SECONDS", "900"))}
+REAPER_TICK = float(os.environ.get("REAPER_TICK", "5"))
+REAPED = metrics.counter("bot_reaped_sessions_total", "Sessions closed by the idle reaper.", ("kind",))
+def pair_key(a, b): return (a, b) if a < b else (b, a)
+
+class TimerWheel:
+    """Hashed timing wheel. A deadline is rounded up to a whole tick and appended to slot (tick % size);
+    advance() visits only the slots whose tick has passed, and entries more than one turn away stay put."""
+    def __init__(self, tick, size=1024):
+        self.tick, self.size, self.slots, self.count = tick, size, [[] for _ in range(size)], 0
+        self.current = int(time.monotonic() // tick)
+    def schedule(self, deadline, item):
+        due = max(-int(-deadline // self.tick), self.current + 1); self.slots[due % self.size].append((due, item)); self.count += 1
+    def advance(self, now):
+        expired, target = [], int(now // self.tick)
+        while self.current < target:
+            self.current += 1; i = self.current % self.size; slot = self.slots[i]
+            if not slot: continue
+            keep = [entry for entry in slot if entry[0] > self.current]
+            expired.extend(item for due, item in slot if due <= self.current)
+            self.slots[i] = keep; self.count -= len(slot) - len(keep)
+        return expired
+
+class Reaper:
+    """Idle expiry for searches, chats, invites and games, keyed by (kind, key). Touching a session only
+    stores a timestamp; the wheel entry is checked lazily when it fires and pushed back if the session
+    was active meanwhile, so touch, watch and forget are all O(1). Each watch gets a generation number,
+    so stale wheel entries of a forgotten or re-watched session are dropped instead of piling up.
+    With a `shared` state backend (Redis), the process that watches a session is not necessarily the one
+    that sees its traffic, so touches are also published there (at most once per tick per session) and
+    a session is only closed if no process has touched it within its timeout."""
+    def __init__(self, timeouts, tick):
+        self.timeouts, self.wheel, self._seen, self._gen = timeouts, TimerWheel(tick), {}, 0
+        self.shared, self._published = None, {}
+    def __len__(self): return len(self._seen)
+    def watch(self, kind, key, idle=0.0):
+        if self.timeouts[kind] <= 0: return  # a zero timeout turns reaping off for that kind
+        self._gen += 1; now = time.monotonic() - idle; self._seen[(kind, key)] = [now, self._gen]
+        self.wheel.schedule(now + self.timeouts[kind], (kind, key, self._gen))
+    def touch(self, kind, key):
+        now = time.monotonic(); entry = self._seen.get((kind, key))
+        if entry is not None: entry[0] = now
+        if self.shared is not None and self.timeouts[kind] > 0 and now - self._published.get((kind, key), -self.wheel.tick) >= self.wheel.tick:
+            self._published[(kind, key)] = now; self.shared.mark_active(kind, key, self.timeouts[kind])
+    def forget(self, kind, key): self._seen.pop((kind, key), None)
+    def adopt(self, snapshot):
+        """Watch every session of a restored MemoryState snapshot, as if it had just been active."""
+        for _, user_id, _ in snapshot["waiting"]: self.watch("search", user_id)
+        for user_id, partner_id in snapshot["chats"].items():
+            if user_id < partner_id: self.watch("chat", (user_id, partner_id))
+        for invitee_id, inviter_id in snapshot["invites"].items(): self.watch("invite", (invitee_id, inviter_id))
+        for game in snapshot["games"]: self.watch("game", pair_key(game["p1"], game["p2"]))
+    def expired(self, now):
+        for kind, key, gen in self.wheel.advance(now):
+            entry = self._seen.get((kind, key))
+            if entry is None or entry[1] != gen: continue
+            deadline = entry[0] + self.timeouts[kind]
+            if deadline > now: self.wheel.schedule(deadline, (kind, key, gen)); continue
+            del self._seen[(kind, key)]; yield kind, key
+    async def _active_elsewhere(self, kind, key):
+        last = await self.shared.last_active(kind, key)
+        idle = time.time() - last if last is not None else self.timeouts[kind]
+        if idle >= self.timeouts[kind]: return False
+        self.watch(kind, key, idle); return True
+    async def run(self, on_expire):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            now = time.monotonic(); self._published = {session: at for session, at in self._published.items() if now - at < self.wheel.tick}
+            for kind, key in self.expired(now):
+                try:
+                    if self.shared is not None and await self._active_elsewhere(kind, key): continue
+                    if await on_expire(kind, key): REAPED.inc(kind)
+                except Exception as e: SWALLOWED_ERRORS.inc("reaper"); print(f"Reaping {kind} {key} failed: {e}")
+
+reaper = Reaper(IDLE_TIMEOUTS, REAPER_TICK)
+
+# --- FLOOD GUARD ---
+# Per-user budgets as (tokens/second, burst). "relay" is chat messages and media, "match" is commands and menu buttons
+# (each one takes locks and SQLite round-trips and can message a partner), "callback" is inline buttons. 0 turns a budget off.
+FLOOD_LIMITS = {"relay": (float(os.environ.get("FLOOD_RELAY_RATE", "3")), float(os.environ.get("FLOOD_RELAY_BURST", "30"))),
+                "match": (float(os.environ.get("FLOOD_MATCH_RATE", "0.5")), float(os.environ.get("FLOOD_MATCH_BURST", "10"))),
+                "callback": (float(os.environ.get("FLOOD_CALLBACK_RATE", "2")), float(os.environ.get("FLOOD_CALLBACK_BURST", "10")))}
+FLOOD_SHED = metrics.counter("bot_flood_shed_total", "Updates dropped by the per-user flood guard before any handler ran, by budget.", ("budget",))
+
+class FloodGuard:
+    """Token buckets for every budget of a user, kept as one flat [tokens..., stamp] list per user and
+    refilled lazily from the stamp when the user next sends something. allow() is a dict lookup and a
+    few float operations. Users idle long enough for every bucket to be full again are pruned, since a
+    full bucket is exactly what a new entry would start with."""
+    def __init__(self, limits):
+        self.slots = {kind: i for i, kind in enumerate(limits)}
+        self.rates, self.bursts = [rate for rate, _ in limits.values()], [max(1.0, burst) for _, burst in limits.values()]
+        self.idle = max((burst / rate for rate, burst in zip(self.rates, self.bursts) if rate > 0), default=0.0)
+        self._buckets, self._pruned_at = {}, time.monotonic()
+    def __len__(self): return len(self._buckets)
+    def allow(self, user_id, kind, now):
+        i = self.slots[kind]
+        if self.rates[i] <= 0: return True
+        bucket = self._buckets.get(user_id)
+        if bucket is None: bucket = self._buckets[user_id] = self.bursts + [now]
+        else:
+            elapsed = now - bucket[-1]; bucket[-1] = now
+            for j, rate in enumerate(self.rates): bucket[j] = min(self.bursts[j], bucket[j] + elapsed * rate)
+        if now - self._pruned_at > 60: self.prune(now)
+        if bucket[i] < 1: return False
+        bucket[i] -= 1; return True
+    def prune(self, now):
+        self._pruned_at = now
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if now - bucket[-1] > self.idle]: del self._buckets[user_id]
+
+flood_guard = FloodGuard(FLOOD_LIMITS)
+
+async def admit_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Registered in group -1, ahead of every handler: a user over budget gets the update dropped here,
+    before it can reach SQLite, the user locks or the outbox."""
+    user = update.effective_user
+    if user is None or user.id == ADMIN_CHAT_ID: return
+    if update.callback_query is not None: kind = "callback"
+    elif update.message is not None: text = update.message.text; kind = "match" if text and (text.startswith("/") or text in MENU_COMMANDS) else "relay"
+    else: return
+    if not flood_guard.allow(user.id, kind, time.monotonic()): FLOOD_SHED.inc(kind); raise ApplicationHandlerStop
+
+# --- TMDb SUGGESTIONS ---
+TMDB_BASE_URL = os.environ.get("TMDB_BASE_URL", "https://api.themoviedb.org/3")
+TMDB_TTL = float(os.environ.get("TMDB_TTL", "21600"))
+TMDB_QUERIES = {
+    "movie": ("/movie/popular", {}, 50),
+    "anime": ("/discover/tv", {'with_keywords': '210024|287501', 'with_origin_country': 'JP'}, 20),
+}
+
+def _percentile(samples, q):
+    if not samples: return 0.0
+    ordered = sorted(samples); return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class SuggestionService:
+    """Pre-fetched pool of TMDb candidates per suggestion type, refilled in the background.
+    Entries older than the TTL are only served when TMDb is failing; each chat pair keeps a set of
+    titles it has already seen, as (kind, tmdb id) since movie and TV ids overlap, so it never gets
+    the same suggestion twice."""
+    def __init__(self, api_key, base_url, ttl, low_water=15, max_size=200):
+        self.api_key, self.base_url, self.ttl, self.low_water, self.max_size = api_key, base_url, ttl, low_water, max_size
+        self._pools = {kind: OrderedDict() for kind in TMDB_QUERIES}  # tmdb id -> (fetched_at, poster_url, message)
+        self._refills, self._seen, self._client = {}, {}, None
+        self.counters = {"hits": 0, "misses": 0, "stale_served": 0, "refills": 0, "refill_errors": 0}
+        self._serve_times, self._refill_times = deque(maxlen=1000), deque(maxlen=200)
+    @staticmethod
+    def _format(item):
         title = item.get('title') or item.get('name')
-        overview = item.get('overview', 'No description available.')
+        overview = item.get('overview') or 'No description available.'
         rating = item.get('vote_average', 0)
         poster_path = item.get('poster_path')
         poster_url = f"https://image.tmdb.org/t/p/w500{poster_path}" if poster_path else None
         message = (f"**{title}**\n\n"
                    f"⭐ **Rating:** {rating:.1f}/10\n\n"
-                   f"**Synopsis:**\n_{overview[:250] + '...' if len(overview ) > 250 else overview}_")
+                   f"**Synopsis:**\n_{overview[:250] + '...' if len(overview) > 250 else overview}_")
+        return poster_url, message
+    async def _fetch(self, kind):
+        if self._client is None: self._client = httpx.AsyncClient(base_url=self.base_url, timeout=10)
+        endpoint, extra, max_page = TMDB_QUERIES[kind]
+        started = time.perf_counter()
+        try:
+            response = await self._client.get(endpoint, params={'api_key': self.api_key, 'language': 'en-US', 'page': random.randint(1, max_page), **extra})
+            response.raise_for_status()
+            results = response.json().get('results') or []
+        except Exception as e:
+            self.counters["refill_errors"] += 1; SWALLOWED_ERRORS.inc("tmdb"); print(f"TMDb Error: {e}"); return
+        finally: self._refill_times.append(time.perf_counter() - started)
+        pool, now = self._pools[kind], time.monotonic()
+        for item in results:
+            if item.get('id') is None or not (item.get('title') or item.get('name')): continue
+            pool.pop(item['id'], None); pool[item['id']] = (now,) + self._format(item)
+        while len(pool) > self.max_size: pool.popitem(last=False)
+        self.counters["refills"] += 1
+    def _refill(self, kind):
+        task = self._refills.get(kind)
+        if task is None or task.done(): task = self._refills[kind] = asyncio.create_task(self._fetch(kind))
+        return task
+    def _pick(self, kind, seen, fresh_only):
+        cutoff = time.monotonic() - self.ttl
+        candidates = [key for key, entry in self._pools[kind].items() if (kind, key) not in seen and (entry[0] >= cutoff or not fresh_only)]
+        return random.choice(candidates) if candidates else None
+    def prefetch(self):
+        if self.api_key:
+            for kind in TMDB_QUERIES: self._refill(kind)
+    async def get(self, kind, pair=()):
+        if not self.api_key: return None, "Suggestion feature is currently disabled."
+        started = time.perf_counter(); seen = self._seen.setdefault(frozenset(pair), set()) if pair else set()
+        cutoff = time.monotonic() - self.ttl
+        if sum(1 for entry in self._pools[kind].values() if entry[0] >= cutoff) < self.low_water: self._refill(kind)
+        key = self._pick(kind, seen, fresh_only=True)
+        if key is not None: self.counters["hits"] += 1
+        else:
+            self.counters["misses"] += 1
+            await asyncio.shield(self._refill(kind))
+            key = self._pick(kind, seen, fresh_only=True)
+            if key is None:
+                key = self._pick(kind, seen, fresh_only=False)
+                if key is None: return None, "Could not find a suggestion right now."
+                self.counters["stale_served"] += 1
+        seen.add((kind, key)); self._serve_times.append(time.perf_counter() - started)
+        _, poster_url, message = self._pools[kind][key]
         return poster_url, message
-    except Exception as e:
-        print(f"TMDb Error: {e}")
-        return None, "An error occurred while getting a suggestion."
+    def forget_pair(self, *pair): self._seen.pop(frozenset(pair), None)
+    def stats(self):
+        return {**self.counters, "pool": {kind: len(pool) for kind, pool in self._pools.items()},
+                "serve_p50_ms": _percentile(self._serve_times, 0.5) * 1000, "serve_p99_ms": _percentile(self._serve_times, 0.99) * 1000,
+                "refill_p50_ms": _percentile(self._refill_times, 0.5) * 1000, "refill_p99_ms": _percentile(self._refill_times, 0.99) * 1000}
+    async def close(self):
+        for task in self._refills.values(): task.cancel()
+        if self._client is not None: await self._client.aclose()
+
+suggestions = SuggestionService(TMDB_API_KEY, TMDB_BASE_URL, TMDB_TTL)
+
+# --- OUTBOUND DISPATCHER ---
+SEND_RATE = float(os.environ.get("SEND_RATE", "30"))  # Telegram's global limit is about 30 messages/s
+CHAT_SEND_RATE, CHAT_SEND_BURST = float(os.environ.get("CHAT_SEND_RATE", "1")), float(os.environ.get("CHAT_SEND_BURST", "5"))
+OUTBOX_MAX_PER_CHAT, OUTBOX_MAX_TOTAL, OUTBOX_MAX_RETRIES = 100, 50000, 3
+OUTBOX_GLOBAL_FLOOD_CHATS, OUTBOX_GLOBAL_FLOOD_WINDOW = 3, 1.0  # this many chats told to retry within the window means the bot-wide limit
+PRIORITY_RELAY, PRIORITY_NORMAL, PRIORITY_BULK = 0, 1, 2
+
+class OutboxFull(Exception): pass
+class JobCancelled(Exception): """Raised by a job's factory to drop the job without calling the Bot API."""
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+    def __init__(self, rate, capacity): self.rate, self.capacity, self.tokens, self.stamp = rate, capacity, capacity, time.monotonic()
+    def take(self, now):
+        """Consume a token and return 0, or return how many seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate); self.stamp = now
+        if self.tokens >= 1: self.tokens -= 1; return 0.0
+        return (1 - self.tokens) / self.rate
+    def refund(self): self.tokens = min(self.capacity, self.tokens + 1)
+    def hold(self, now, seconds):
+        """Make the next token available no sooner than `seconds` from now."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate, 1 - seconds * self.rate); self.stamp = now
+    def full(self, now): return self.tokens + (now - self.stamp) * self.rate >= self.capacity
+
+class _OutboundJob:
+    __slots__ = ("factory", "future", "priority", "key", "enqueued", "attempts")
+    def __init__(self, factory, future, priority, key):
+        self.factory, self.future, self.priority, self.key, self.enqueued, self.attempts = factory, future, priority, key, time.monotonic(), 0
+
+class Outbox:
+    """Central scheduler for outbound Bot API calls. Each chat has a FIFO queue with at most one call in
+    flight, so a chat sees messages in the order they were submitted. Chats are served through a global
+    token bucket and a per-chat bucket, relayed chat messages ahead of everything else and broadcasts
+    (PRIORITY_BULK) behind it. RetryAfter holds back that chat's bucket for the requested time and the call
+    is retried; only when several chats get one within OUTBOX_GLOBAL_FLOOD_WINDOW (the bot-wide limit, not
+    one chat's) is the whole dispatcher paused. Jobs with the same `key` in the same chat coalesce (only the newest is sent), which is
+    what the X-O board edits want."""
+    def __init__(self, rate, chat_rate, chat_burst, max_per_chat, max_total):
+        self.bucket, self.chat_rate, self.chat_burst = TokenBucket(rate, rate), chat_rate, chat_burst
+        self.max_per_chat, self.max_total = max_per_chat, max_total
+        self._queues, self._chat_buckets, self._ready, self._scheduled = {}, {}, (deque(), deque(), deque()), set()
+        self._wakeup, self._paused_until, self._task, self.depth, self.in_flight = asyncio.Event(), 0.0, None, 0, 0
+        self._pruned_at, self._flood_waits = time.monotonic(), deque()
+        self.counters = {"sent": 0, "failed": 0, "dropped": 0, "coalesced": 0, "retry_after": 0, "cancelled": 0}
+        self._latency = tuple(deque(maxlen=2000) for _ in self._ready)
+    def _schedule(self, chat_id):
+        queue = self._queues.get(chat_id)
+        if not queue:
+            self._queues.pop(chat_id, None); bucket = self._chat_buckets.get(chat_id)
+            if bucket is not None and bucket.full(time.monotonic()): del self._chat_buckets[chat_id]
+            return
+        if chat_id not in self._scheduled: self._scheduled.add(chat_id); self._ready[queue[0].priority].append(chat_id); self._wakeup.set()
+    def _requeue(self, chat_id):
+        queue = self._queues.get(chat_id)
+        if queue: self._ready[queue[0].priority].append(chat_id); self._wakeup.set()
+        else: self._scheduled.discard(chat_id); self._schedule(chat_id)
+    def submit(self, chat_id, factory, priority=PRIORITY_NORMAL, key=None):
+        """Queue `factory()` (a zero-argument callable returning the Bot API coroutine) for `chat_id` and
+        return a future with its result."""
+        future = asyncio.get_running_loop().create_future(); queue = self._queues.get(chat_id)
+        if queue is None: queue = self._queues[chat_id] = deque()
+        if key is not None:
+            for job in queue:
+                if job.key == key:
+                    job.factory, superseded, job.future = factory, job.future, future; self.counters["coalesced"] += 1
+                    if not superseded.done(): superseded.set_result(None)
+                    return future
+        if len(queue) >= self.max_per_chat or self.depth >= self.max_total:
+            victim = next((job for job in queue if job.priority > priority), None)
+            if victim is None:
+                self.counters["dropped"] += 1; future.set_exception(OutboxFull(f"outbound queue for {chat_id} is full"))
+                self._schedule(chat_id); return future
+            queue.remove(victim); self.depth -= 1; self.counters["dropped"] += 1
+            if not victim.future.done(): victim.future.set_exception(OutboxFull(f"outbound queue for {chat_id} is full"))
+        queue.append(_OutboundJob(factory, future, priority, key)); self.depth += 1; self._schedule(chat_id)
+        return future
+    def submit_next(self, chat_id, factories, priority=PRIORITY_NORMAL):
+        """Queue jobs at the front of `chat_id`'s queue, in order; for a running job that hands the rest of
+        its work to separate jobs, which keep its place ahead of everything queued after it. Returns their futures."""
+        loop, queue = asyncio.get_running_loop(), self._queues.setdefault(chat_id, deque())
+        jobs = [_OutboundJob(factory, loop.create_future(), priority, None) for factory in factories]
+        queue.extendleft(reversed(jobs)); self.depth += len(jobs); self._schedule(chat_id)
+        return [job.future for job in jobs]
+    async def send(self, chat_id, factory, priority=PRIORITY_NORMAL, key=None): return await self.submit(chat_id, factory, priority, key)
+    def post(self, chat_id, factory, priority=PRIORITY_NORMAL, key=None):
+        """Fire-and-forget variant of submit(); failures are logged instead of raised."""
+        self.submit(chat_id, factory, priority, key).add_done_callback(partial(self._log_failure, chat_id))
+    @staticmethod
+    def _log_failure(chat_id, future):
+        if future.cancelled() or future.exception() is None or isinstance(future.exception(), (OutboxFull, JobCancelled)): return
+        SWALLOWED_ERRORS.inc("outbox_post"); print(f"Failed to send to {chat_id}: {future.exception()}")
+    async def _acquire(self):
+        while True:
+            now = time.monotonic(); delay = self._paused_until - now
+            if delay <= 0: delay = self.bucket.take(now)
+            if delay <= 0: return
+            await asyncio.sleep(delay)
+    def _prune(self, now):
+        """Forget the rate state of idle chats; a bucket that has refilled is the same as a new one."""
+        self._pruned_at = now
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if chat_id not in self._queues and bucket.full(now)]: del self._chat_buckets[chat_id]
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if time.monotonic() - self._pruned_at > 60: self._prune(time.monotonic())
+            if not any(self._ready): self._wakeup.clear(); await self._wakeup.wait(); continue
+            await self._acquire()
+            chat_id = next(ready for ready in self._ready if ready).popleft(); queue = self._queues.get(chat_id)
+            if not queue: self.bucket.refund(); self._scheduled.discard(chat_id); self._schedule(chat_id); continue
+            delay = self._chat_bucket(chat_id).take(time.monotonic())
+            if delay > 0: self.bucket.refund(); loop.call_later(delay, self._requeue, chat_id); continue
+            job = queue.popleft(); self.depth -= 1; self.in_flight += 1
+            asyncio.create_task(self._send(chat_id, job))
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None: bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    def _flood_wait(self, chat_id, seconds):
+        now = time.monotonic(); self._chat_bucket(chat_id).hold(now, seconds)
+        waits = self._flood_waits; waits.append((now, chat_id))
+        while waits[0][0] < now - OUTBOX_GLOBAL_FLOOD_WINDOW: waits.popleft()
+        if len({waiting for _, waiting in waits}) >= OUTBOX_GLOBAL_FLOOD_CHATS: self._paused_until = max(self._paused_until, now + seconds)
+    async def _send(self, chat_id, job):
+        try: result = await job.factory()
+        except JobCancelled as e:  # nothing was sent, so the tokens it took are still unused
+            self.counters["cancelled"] += 1; self.bucket.refund(); self._chat_bucket(chat_id).refund()
+            if not job.future.done(): job.future.set_exception(e)
+        except RetryAfter as e:
+            self.counters["retry_after"] += 1; self._flood_wait(chat_id, float(e.retry_after))
+            if job.attempts < OUTBOX_MAX_RETRIES and not job.future.done():
+                job.attempts += 1; self._queues.setdefault(chat_id, deque()).appendleft(job); self.depth += 1
+            else:
+                self.counters["failed"] += 1
+                if not job.future.done(): job.future.set_exception(e)
+        except Exception as e:
+            self.counters["failed"] += 1
+            if not job.future.done(): job.future.set_exception(e)
+        else:
+            self.counters["sent"] += 1; self._latency[job.priority].append(time.monotonic() - job.enqueued)
+            if not job.future.done(): job.future.set_result(result)
+        finally: self.in_flight -= 1; self._scheduled.discard(chat_id); self._schedule(chat_id)
+    def start(self):
+        if self._task is None: self._task = asyncio.create_task(self._run())
+    async def close(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while (self.depth or self.in_flight) and time.monotonic() < deadline: await asyncio.sleep(0.05)
+        if self._task is not None: self._task.cancel(); self._task = None
+    def stats(self):
+        return {**self.counters, "queued": self.depth, "in_flight": self.in_flight, "chats_queued": len(self._queues),
+                "relay_latency_p50_ms": _percentile(self._latency[PRIORITY_RELAY], 0.5) * 1000, "relay_latency_p99_ms": _percentile(self._latency[PRIORITY_RELAY], 0.99) * 1000,
+                "other_latency_p50_ms": _percentile(self._latency[PRIORITY_NORMAL], 0.5) * 1000, "other_latency_p99_ms": _percentile(self._latency[PRIORITY_NORMAL], 0.99) * 1000}
+
+outbox = Outbox(SEND_RATE, CHAT_SEND_RATE, CHAT_SEND_BURST, OUTBOX_MAX_PER_CHAT, OUTBOX_MAX_TOTAL)
+
+# Handlers answer through the outbox as well, so replies share its rate limits and stay in order with
+# whatever else is already queued for that chat.
+def post_reply(message, text, **kwargs): outbox.post(message.chat_id, partial(message.reply_text, text, **kwargs))
+def post_edit(query, text, **kwargs): outbox.post(query.message.chat_id, partial(query.edit_message_text, text, **kwargs))
+def post_delete(query): outbox.post(query.message.chat_id, query.message.delete)
+def post_answer(query, text=None):
+    # Answers are not chat messages and the spinner waits on them, so they get a queue of their own per user
+    outbox.post(("answers", query.from_user.id), partial(query.answer, text))
+def post_confirmed(chat_id, factory, message, sent_text, failed_text, error_name):
+    """Queue a send to another chat, then reply to `message` with how it went ({error} in failed_text is filled in)."""
+    outbox.submit(chat_id, factory).add_done_callback(partial(_confirm, message, sent_text, failed_text, error_name))
+def _confirm(message, sent_text, failed_text, error_name, future):
+    if future.cancelled(): return
+    if future.exception() is None: post_reply(message, sent_text); return
+    SWALLOWED_ERRORS.inc(error_name); post_reply(message, failed_text.format(error=future.exception()))
+
+# --- ALBUM RELAY ---
+ALBUM_WINDOW = float(os.environ.get("ALBUM_WINDOW", "1.0"))  # seconds of quiet after which an album is complete
+ALBUM_MAX_ITEMS = 10  # Telegram's own limit per album
+
+def input_media(message):
+    kwargs = {"caption": message.caption, "caption_entities": message.caption_entities}
+    if message.photo: return InputMediaPhoto(message.photo[-1].file_id, **kwargs)
+    if message.video: return InputMediaVideo(message.video.file_id, **kwargs)
+    if message.document: return InputMediaDocument(message.document.file_id, **kwargs)
+    if message.audio: return InputMediaAudio(message.audio.file_id, **kwargs)
+    return None
+
+class _Album:
+    __slots__ = ("messages", "ready", "timer")
+    def __init__(self, ready): self.messages, self.ready, self.timer = [], ready, None
+
+class AlbumRelay:
+    """Relays an album (messages sharing a media_group_id) as one send_media_group call. The first item
+    to arrive takes the album's place in the partner's outbox queue right away, so messages sent after
+    the album stay behind it; that job waits until no item has arrived for ALBUM_WINDOW seconds (or the
+    album is full) and then sends everything in message order. An album send_media_group can't carry
+    goes out as single copies: the job sends the first and hands the others to `queue_copies`, which
+    queues one job per copy right behind it."""
+    def __init__(self, window, max_items): self.window, self.max_items, self._albums = window, max_items, {}
+    def __len__(self): return len(self._albums)
+    def _complete(self, key):
+        album = self._albums.pop(key, None)
+        if album is not None and not album.ready.done(): album.ready.set_result(None)
+    def join(self, message):
+        """Buffer one album item; returns (album, whether this is its first item)."""
+        key, loop = (message.chat_id, message.media_group_id), asyncio.get_running_loop()
+        album = self._albums.get(key); first = album is None
+        if first: album = self._albums[key] = _Album(loop.create_future())
+        album.messages.append(message)
+        if album.timer is not None: album.timer.cancel()
+        if len(album.messages) >= self.max_items: self._complete(key)
+        else: album.timer = loop.call_later(self.window, self._complete, key)
+        return album, first
+    async def send(self, bot, partner_id, album, queue_copies):
+        await album.ready
+        messages = sorted(album.messages, key=lambda m: m.message_id); media = [input_media(m) for m in messages]
+        if len(media) < 2 or None in media:  # a lone straggler, or something send_media_group can't carry
+            album.messages = messages[:1]  # if the outbox retries this job, the rest must not be queued twice
+            if len(messages) > 1: queue_copies(messages[1:])
+            return await messages[0].copy(chat_id=partner_id)
+        return await bot.send_media_group(partner_id, media)
+
+albums = AlbumRelay(ALBUM_WINDOW, ALBUM_MAX_ITEMS)
+
+# --- BROADCAST ---
+BROADCAST_CHUNK = int(os.environ.get("BROADCAST_CHUNK", "500"))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "50"))
+BROADCAST_PROGRESS_INTERVAL = 5.0
+BROADCAST_MESSAGES = metrics.counter("bot_broadcast_messages_total", "Broadcast deliveries by outcome.", ("result",))
+
+def is_gone(error):
+    """True for Bot API errors meaning the user blocked the bot or no longer exists."""
+    return isinstance(error, Forbidden) or (isinstance(error, BadRequest) and "chat not found" in str(error).lower())
+
+class Broadcaster:
+    """Sends an admin message to every user who hasn't blocked the bot, one run at a time. Recipients are
+    read from `users` in user_id order, BROADCAST_CHUNK rows per query (keyset pagination, so the table is
+    never held in memory), and go through the outbox at PRIORITY_BULK with at most BROADCAST_CONCURRENCY
+    sends pending, so chat traffic and the global rate limit come first. After each chunk the last
+    user_id and the counters are saved to the `broadcasts` row and an interrupted run resumes from there
+    (stop() lets the sends already handed to the outbox finish, so stop/resume sends nobody twice; a
+    crash can repeat at most one chunk). A send that fails while stopping is most likely the shutdown
+    itself, so instead of counting it as failed its user goes to the row's `pending` list, which the
+    resumed run sends first. Users the Bot API reports as gone get users.blocked = 1 and are skipped by
+    later broadcasts."""
+    def __init__(self, chunk, concurrency, progress_interval):
+        self.chunk, self.concurrency, self.progress_interval, self.task, self._stopping = chunk, concurrency, progress_interval, None, False
+    @property
+    def running(self): return self.task is not None and not self.task.done()
+    @staticmethod
+    def _create(conn, text):
+        if conn.execute("SELECT 1 FROM broadcasts WHERE status = 'running'").fetchone(): return None  # resume or cancel that one first
+        return conn.execute("INSERT INTO broadcasts (text) VALUES (?)", (text,)).lastrowid
+    @staticmethod
+    def _checkpoint(conn, row, gone):
+        conn.execute("UPDATE broadcasts SET last_user_id = ?, pending = ?, sent = ?, failed = ?, blocked = ? WHERE id = ?",
+                     (row["last_user_id"], json.dumps(row["pending"]), row["sent"], row["failed"], row["blocked"], row["id"]))
+        conn.executemany("UPDATE users SET blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in gone])
+    async def start(self, bot, text, admin_chat_id):
+        """Start a new broadcast; returns its row, or None if an unfinished one is waiting to be resumed."""
+        broadcast_id = await storage.transact(self._create, text)
+        return None if broadcast_id is None else await self.resume(bot, admin_chat_id, broadcast_id)
+    async def resume(self, bot, admin_chat_id, broadcast_id=None):
+        """Run the given broadcast, or the latest unfinished one; returns its row, or None if there is none."""
+        if broadcast_id is None: row = await storage.fetchone("SELECT * FROM broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1")
+        else: row = await storage.fetchone("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,))
+        if row is not None:
+            run = dict(row); run["pending"] = json.loads(run["pending"] or "[]")
+            self.task = asyncio.create_task(self._run(bot, run, admin_chat_id))
+        return row
+    async def cancel(self):
+        """Give up on the unfinished broadcast (not while it runs); returns its id, or None if there is none."""
+        row = await storage.fetchone("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id DESC LIMIT 1")
+        if row is not None: await storage.execute("UPDATE broadcasts SET status = 'abandoned' WHERE id = ?", (row["id"],))
+        return row["id"] if row else None
+    async def stop(self):
+        if not self.running: return False
+        self._stopping = True
+        try: await self.task
+        finally: self._stopping = False
+        return True
+    async def _fetch(self, after_user_id):
+        rows = await storage.fetchall("SELECT user_id FROM users WHERE user_id > ? AND blocked = 0 ORDER BY user_id LIMIT ?", (after_user_id, self.chunk))
+        return [row["user_id"] for row in rows]
+    async def _deliver(self, bot, slots, user_id, text, results, i):
+        async with slots:
+            if self._stopping: return  # slots are granted in order, so everything after this is skipped too
+            try: await outbox.send(user_id, partial(bot.send_message, user_id, text), PRIORITY_BULK); results[i] = "sent"
+            except Exception as e: results[i] = "blocked" if is_gone(e) else "retry" if self._stopping else "failed"
+    async def _send_chunk(self, bot, slots, row, user_ids):
+        results = [None] * len(user_ids)
+        await asyncio.gather(*(self._deliver(bot, slots, user_id, row["text"], results, i) for i, user_id in enumerate(user_ids)))
+        return results
+    async def _record(self, row, user_ids, results, resend=False):
+        if resend:  # a run of row["pending"]: whatever didn't go out this time stays pending
+            finished = [(user_id, result) for user_id, result in zip(user_ids, results) if result is not None]
+            row["pending"] = [user_id for user_id, result in zip(user_ids, results) if result in (None, "retry")]
+        else:
+            done = next((i for i, result in enumerate(results) if result is None), len(results))
+            if not done: return
+            finished = list(zip(user_ids[:done], results[:done])); row["last_user_id"] = user_ids[done - 1]
+            row["pending"] = row["pending"] + [user_id for user_id, result in finished if result == "retry"]
+        for _, result in finished:
+            if result != "retry": row[result] += 1; BROADCAST_MESSAGES.inc(result)
+        await storage.transact(self._checkpoint, row, [user_id for user_id, result in finished if result == "blocked"])
+    def _report(self, bot, admin_chat_id, message_id, row, total, done_before, started, final=False):
+        done = row["sent"] + row["failed"] + row["blocked"]; rate = (done - done_before) / max(time.monotonic() - started, 1e-6)
+        text = (f"📣 Broadcast #{row['id']} {'finished' if final else 'running'}: {done}/{total}\n"
+                f"✅ {row['sent']} sent, 🚫 {row['blocked']} blocked, ⚠️ {row['failed']} failed\n{rate:.1f} msg/s")
+        if not final and rate: text += f", ETA {timedelta(seconds=int((total - done) / rate))}"
+        outbox.post(admin_chat_id, partial(bot.edit_message_text, text, chat_id=admin_chat_id, message_id=message_id), key=("broadcast", message_id))
+    async def _run(self, bot, row, admin_chat_id):
+        try: await self._broadcast(bot, row, admin_chat_id)
+        except Exception as e: SWALLOWED_ERRORS.inc("broadcast"); print(f"Broadcast #{row['id']} failed: {e!r}")
+    async def _broadcast(self, bot, row, admin_chat_id):
+        remaining = (await storage.fetchone("SELECT COUNT(*) AS n FROM users WHERE user_id > ? AND blocked = 0", (row["last_user_id"],)))["n"] + len(row["pending"])
+        done_before = row["sent"] + row["failed"] + row["blocked"]; total = done_before + remaining
+        message_id = (await outbox.send(admin_chat_id, partial(bot.send_message, admin_chat_id, f"📣 Broadcast #{row['id']}: sending to {remaining} users..."))).message_id
+        slots, started = asyncio.Semaphore(self.concurrency), time.monotonic(); reported = started
+        if row["pending"]:
+            pending = row["pending"]; await self._record(row, pending, await self._send_chunk(bot, slots, row, pending), resend=True)
+        user_ids = [] if self._stopping else await self._fetch(row["last_user_id"])
+        while user_ids:
+            prefetch = asyncio.create_task(self._fetch(user_ids[-1]))  # read the next chunk while this one sends
+            await self._record(row, user_ids, await self._send_chunk(bot, slots, row, user_ids))
+            if self._stopping: prefetch.cancel(); break
+            user_ids = await prefetch
+            if time.monotonic() - reported >= self.progress_interval: reported = time.monotonic(); self._report(bot, admin_chat_id, message_id, row, total, done_before, started)
+        else:
+            if not self._stopping:
+                await storage.execute("UPDATE broadcasts SET status = 'done' WHERE id = ?", (row["id"],))
+                self._report(bot, admin_chat_id, message_id, row, total, done_before, started, final=True); return
+        self._report(bot, admin_chat_id, message_id, row, total, done_before, started)  # stopped; the row stays resumable
+
+broadcaster = Broadcaster(BROADCAST_CHUNK, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_INTERVAL)
 
 # --- CORE BOT HANDLERS ---
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user; is_new_user = add_user(user.id, user.first_name)
+    user = update.effective_user; is_new_user = await add_user(user.id, user.first_name)
+    if not is_new_user: storage.submit([("UPDATE users SET blocked = 0 WHERE user_id = ? AND blocked = 1", (user.id,))])  # they're back
     if context.args and context.args[0].startswith('ref_') and is_new_user:
         try:
             referrer_id = int(context.args[0].split('_')[1])
-            if get_user(referrer_id) and user.id != referrer_id:
-                grant_points(user.id, 5); grant_points(referrer_id, 5)
-                await update.message.reply_text("Welcome! You and your friend have both received 5 bonus points!")
-                await context.bot.send_message(referrer_id, f"🎉 Your friend {user.first_name} joined! You both earned 5 points.")
-        except Exception: pass
-    await update.message.reply_text("Welcome!", reply_markup=main_menu_keyboard()); await check_registration(update, context)
+            if user.id != referrer_id and await ledger.referral(user.id, referrer_id, 5):
+                post_reply(update.message, "Welcome! You and your friend have both received 5 bonus points!")
+                outbox.post(referrer_id, partial(context.bot.send_message, referrer_id, f"🎉 Your friend {user.first_name} joined! You both earned 5 points."))
+        except Exception: SWALLOWED_ERRORS.inc("referral")
+    post_reply(update.message, "Welcome!", reply_markup=MAIN_MENU_KEYBOARD); await check_registration(update, context)
 
 async def check_registration(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id; user_data = get_user(user_id); message = update.message or update.callback_query.message
-    if not user_data.get("gender"): await message.reply_text("To get started, please tell us your gender:", reply_markup=gender_keyboard())
-    elif not user_data.get("age"): await message.reply_text("Great! Now, please select your age range:", reply_markup=age_keyboard())
-    elif not user_data.get("region"): await message.reply_text("Almost there! Which region are you from?", reply_markup=region_keyboard())
-    elif update.callback_query: await message.reply_text("You are all set! You can now start a chat.")
+    user_id = update.effective_user.id; user_data = await get_user(user_id); message = update.message or update.callback_query.message
+    if not user_data.get("gender"): post_reply(message, "To get started, please tell us your gender:", reply_markup=GENDER_KEYBOARD)
+    elif not user_data.get("age"): post_reply(message, "Great! Now, please select your age range:", reply_markup=AGE_KEYBOARD)
+    elif not user_data.get("region"): post_reply(message, "Almost there! Which region are you from?", reply_markup=REGION_KEYBOARD)
+    elif update.callback_query: post_reply(message, "You are all set! You can now start a chat.")
 
 async def find_partner_flow(update: Update, context: ContextTypes.DEFAULT_TYPE, search_preference: str = "any"):
     user_id = update.effective_user.id; message = update.message
-    async with lock:
-        if user_id in active_chats: await message.reply_text("You are already in a chat."); return
-        user_data = get_user(user_id)
-        if not all(user_data.get(key) for key in ["gender", "age", "region"]): await message.reply_text("Please complete your profile first via /start."); return
-
-        my_gender = user_data["gender"]
-        for pool in waiting_pool.values():
-            if user_id in pool: pool.remove(user_id)
-
-        target_pool_key = "female" if my_gender == "male" and search_preference == "gender" else "male" if my_gender == "female" and search_preference == "gender" else "any"
-        partner_id = None
-
-        if waiting_pool.get(target_pool_key): partner_id = waiting_pool[target_pool_key].pop(0)
-        elif target_pool_key != "any" and waiting_pool.get("any"): partner_id = waiting_pool["any"].pop(0)
-        elif target_pool_key == "any":
-            combined_pools = waiting_pool["male"] + waiting_pool["female"]
-            if combined_pools:
-                partner_id = random.choice(combined_pools)
-                if get_user(partner_id)["gender"] == "male": waiting_pool["male"].remove(partner_id)
-                else: waiting_pool["female"].remove(partner_id)
-
-        if partner_id and partner_id != user_id:
-            active_chats[user_id], active_chats[partner_id] = partner_id, user_id
-            update_user(user_id, "total_chats", get_user(user_id)["total_chats"] + 1)
-            update_user(partner_id, "total_chats", get_user(partner_id)["total_chats"] + 1)
-            user_rep, partner_rep = get_user(user_id)["reputation_score"], get_user(partner_id)["reputation_score"]
-            await context.bot.send_message(partner_id, f"📩 Partner found! Their reputation is {user_rep:.1f}/10.", reply_markup=in_chat_actions_keyboard())
-            await message.reply_text(f"📩 Partner found! Their reputation is {partner_rep:.1f}/10.", reply_markup=in_chat_actions_keyboard())
+    async with user_lock(user_id, "match"):
+        if await state.partner(user_id) is not None: result = "in_chat"
         else:
-            if user_id not in waiting_pool[my_gender]: waiting_pool[my_gender].append(user_id)
-            search_msg = "opposite gender" if search_preference == "gender" else "random"
-            await message.reply_text(f"⏳ Searching for a {search_msg} partner...")
+            user_data = await get_user(user_id)
+            if not all(user_data.get(key) for key in ["gender", "age", "region"]): result = "incomplete"
+            else: result, partner_id = await state.pair_or_enqueue(user_id, user_data, search_preference)
+
+    if result == "in_chat": post_reply(message, "You are already in a chat.")
+    elif result == "incomplete": post_reply(message, "Please complete your profile first via /start.")
+    elif result == "matched":
+        reaper.forget("search", user_id); reaper.forget("search", partner_id); reaper.watch("chat", pair_key(user_id, partner_id))
+        await increment_user(user_id, "total_chats"); await increment_user(partner_id, "total_chats")
+        user_rep, partner_rep = (await get_user(user_id))["reputation_score"], (await get_user(partner_id))["reputation_score"]
+        outbox.post(partner_id, partial(context.bot.send_message, partner_id, f"📩 Partner found! Their reputation is {user_rep:.1f}/10.", reply_markup=IN_CHAT_ACTIONS_KEYBOARD))
+        post_reply(message, f"📩 Partner found! Their reputation is {partner_rep:.1f}/10.", reply_markup=IN_CHAT_ACTIONS_KEYBOARD)
+    else:
+        reaper.watch("search", user_id)
+        search_msg = "opposite gender" if search_preference == "gender" else "random"
+        post_reply(message, f"⏳ Searching for a {search_msg} partner...")
 
+@timed
 async def random_chat_start(update: Update, context: ContextTypes.DEFAULT_TYPE): await find_partner_flow(update, context, search_preference="any")
+@timed
 async def gender_search_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id; user_data = get_user(user_id)
-    if not user_data or not all(user_data.get(key) for key in ["gender", "age", "region"]): await update.message.reply_text("Please complete your profile first via /start."); return
-    if user_data["points"] >= 5:
-        update_user(user_id, "points", user_data["points"] - 5)
-        await update.message.reply_text(f"5 points used. You have {user_data['points'] - 5} left.")
+    user_id = update.effective_user.id; user_data = await get_user(user_id)
+    if not user_data or not all(user_data.get(key) for key in ["gender", "age", "region"]): post_reply(update.message, "Please complete your profile first via /start."); return
+    spent, balance = await ledger.spend(user_id, 5, "gender_search")
+    if spent:
+        post_reply(update.message, f"5 points used. You have {balance} left.")
         await find_partner_flow(update, context, search_preference="gender")
-    else: await update.message.reply_text(f"You need 5 points, but you only have {user_data['points']}.")
-
-async def end_chat_logic(user_id, context):
-    async with lock:
-        was_waiting = any(user_id in pool for pool in waiting_pool.values())
-        if was_waiting:
-            for pool in waiting_pool.values():
-                if user_id in pool: pool.remove(user_id)
-            return "search_cancelled", None
-        if user_id in active_chats:
-            partner_id = active_chats.pop(user_id)
-            active_chats.pop(partner_id, None)
-            if user_id in active_games: del active_games[user_id]
-            if partner_id in active_games: del active_games[partner_id]
-            if user_id in pending_invites.values():
-                inv_key = [k for k, v in pending_invites.items() if v == user_id][0]
-                del pending_invites[inv_key]
-            try: await context.bot.send_message(partner_id, "❌ The other user has left the chat.")
-            except Exception: pass
-            return "chat_ended", partner_id
-    return "not_in_chat", None
+    else: post_reply(update.message, f"You need 5 points, but you only have {balance}.")
+
+async def end_chat_logic(user_id, bot):
+    async with user_lock(user_id, "end"): result, partner_id = await state.end(user_id)
+    if result == "search_cancelled": reaper.forget("search", user_id)
+    elif result == "chat_ended":
+        suggestions.forget_pair(user_id, partner_id); forget_pair_sessions(user_id, partner_id)
+        outbox.post(partner_id, partial(bot.send_message, partner_id, "❌ The other user has left the chat."))
+    return result, partner_id
+
+def forget_pair_sessions(user_id, partner_id):
+    key = pair_key(user_id, partner_id)
+    reaper.forget("chat", key); reaper.forget("game", key); reaper.forget("invite", (user_id, partner_id)); reaper.forget("invite", (partner_id, user_id))
+
+async def reap_session(bot, kind, key):
+    """Close a session the reaper found idle and tell whoever is still there. Returns whether anything was closed."""
+    minutes = int(IDLE_TIMEOUTS[kind] // 60)
+    if kind == "search":
+        async with user_lock(key, "reap"):
+            if not await state.cancel_search(key): return False
+        outbox.post(key, partial(bot.send_message, key, f"⌛ No partner found in {minutes} minutes, so the search was stopped. Tap 🎮 Random Chat to try again."))
+    elif kind == "chat":
+        user_id, partner_id = key
+        async with user_lock(user_id, "reap"):
+            if await state.partner(user_id) != partner_id: return False
+            await state.end(user_id)
+        suggestions.forget_pair(user_id, partner_id); forget_pair_sessions(user_id, partner_id)
+        for p_id in key: outbox.post(p_id, partial(bot.send_message, p_id, f"⌛ The chat was closed after {minutes} minutes without messages."))
+    elif kind == "invite":
+        invitee_id, inviter_id = key
+        if not await state.take_invite(invitee_id, inviter_id): return False
+        outbox.post(inviter_id, partial(bot.send_message, inviter_id, "⌛ Your X-O invitation expired."))
+    elif kind == "game":
+        game = await state.get_game(key[0])
+        if game is None or pair_key(game.p1, game.p2) != key: return False
+        await state.end_game(game)
+        for p_id in key: outbox.post(p_id, partial(bot.send_message, p_id, f"⌛ The X-O game was closed after {minutes} minutes without a move."))
+    return True
 
+@timed
 async def end(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    result, partner_id = await end_chat_logic(update.effective_user.id, context)
-    if result == "search_cancelled": await update.message.reply_text("🛑 Search cancelled.")
-    elif result == "chat_ended": await update.message.reply_text("❌ Chat ended. Please rate your partner:", reply_markup=post_chat_keyboard(partner_id))
-    else: await update.message.reply_text("You are not in a chat or search.")
+    result, partner_id = await end_chat_logic(update.effective_user.id, context.bot)
+    if result == "search_cancelled": post_reply(update.message, "🛑 Search cancelled.")
+    elif result == "chat_ended": post_reply(update.message, "❌ Chat ended. Please rate your partner:", reply_markup=post_chat_keyboard(partner_id))
+    else: post_reply(update.message, "You are not in a chat or search.")
 
+@timed
 async def next_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Switching to a new partner...")
-    result, _ = await end_chat_logic(update.effective_user.id, context)
+    post_reply(update.message, "Switching to a new partner...")
+    result, _ = await end_chat_logic(update.effective_user.id, context.bot)
     if result == "not_in_chat":
-        await update.message.reply_text("You weren't in a chat, starting a new search.")
+        post_reply(update.message, "You weren't in a chat, starting a new search.")
     await find_partner_flow(update, context, search_preference="any")
 
-async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id; message_text = update.message.text
+async def _relay_if_paired(user_id, partner_id, send):
+    # Checked when the outbox gets to the job, not when it was queued: by then the chat may have ended and
+    # the partner may be talking to someone new, who must not receive the old partner's messages.
+    if await state.partner(user_id) != partner_id: raise JobCancelled(f"chat {user_id} -> {partner_id} has ended")
+    return await send()
+
+async def relay_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Queue a copy of the message for the sender's partner; returns False if the sender is not in a chat.
+    Delivery is not awaited: a rate-limited partner would otherwise hold one of the CONCURRENT_UPDATES
+    slots for as long as the outbox makes the message wait. _relay_done reports failures; a copy still
+    queued when the chat ends is dropped (_relay_if_paired)."""
+    started = time.perf_counter(); user_id = update.effective_user.id
+    async with user_lock(user_id, "relay"):  # held only to look up and enqueue, so a user's messages keep their order
+        partner_id = await state.partner(user_id)
+        if partner_id is None: return False
+        copy = partial(_relay_if_paired, user_id, partner_id, partial(update.message.copy, chat_id=partner_id))
+        outbox.submit(partner_id, copy, PRIORITY_RELAY).add_done_callback(partial(_relay_done, context.bot, user_id, partner_id))
+    reaper.touch("chat", pair_key(user_id, partner_id))
+    HANDLER_SECONDS.observe(time.perf_counter() - started, "relay")
+    return True
 
-    command_map = {
-        "🎮 Random Chat": random_chat_start, "🔎 Search by Gender": gender_search_start,
-        "🛑 End Chat": end, "Next ⏭️": next_chat,
-        "👤 My Profile": show_profile, "ℹ️ Help": help_cmd
-    }
+def _relay_done(bot, user_id, partner_id, future):
+    if future.cancelled() or future.exception() is None or isinstance(future.exception(), JobCancelled): return
+    RELAY_FAILURES.inc()
+    if isinstance(future.exception(), Forbidden): asyncio.create_task(_partner_gone(bot, user_id, partner_id)); return
+    outbox.post(user_id, partial(bot.send_message, user_id, "Could not reach your partner."))
 
-    if message_text in command_map:
-        await command_map[message_text](update, context)
-        return
+async def _partner_gone(bot, user_id, partner_id):
+    # the partner blocked the bot or deleted their account; don't leave this user talking to nobody
+    if await state.partner(user_id) != partner_id: return  # already moved on to someone else
+    result, _ = await end_chat_logic(user_id, bot)
+    text = "❌ Your partner has left the bot, so the chat was closed." if result == "chat_ended" else "Could not reach your partner."
+    outbox.post(user_id, partial(bot.send_message, user_id, text))
+
+async def relay_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Buffer one item of an album; the first item queues the whole album for the partner. Returns False
+    if the sender is not in a chat (only for the first item, so the sender is told once)."""
+    user_id = update.effective_user.id; album, first = albums.join(update.message)
+    if not first: return True
+    async with user_lock(user_id, "relay"):
+        partner_id = await state.partner(user_id)
+        if partner_id is None: return False
+        outbox.submit(partner_id, partial(_relay_album, context.bot, user_id, partner_id, album), PRIORITY_RELAY).add_done_callback(partial(_relay_done, context.bot, user_id, partner_id))
+    reaper.touch("chat", pair_key(user_id, partner_id))
+    return True
+
+async def _relay_album(bot, user_id, partner_id, album):
+    await album.ready  # the job holds the album's place in the queue while its items arrive; check the chat after that
+    return await _relay_if_paired(user_id, partner_id, partial(albums.send, bot, partner_id, album, partial(_relay_copies, bot, user_id, partner_id)))
+
+def _relay_copies(bot, user_id, partner_id, messages):
+    copies = [partial(_relay_if_paired, user_id, partner_id, partial(message.copy, chat_id=partner_id)) for message in messages]
+    for future in outbox.submit_next(partner_id, copies, PRIORITY_RELAY): future.add_done_callback(partial(_relay_done, bot, user_id, partner_id))
 
-    if user_id in active_chats:
-        partner_id = active_chats[user_id]
-        try: await update.message.copy(chat_id=partner_id)
-        except Exception: await update.message.reply_text("Could not reach your partner.")
+async def forward_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id; command = MENU_COMMANDS.get(update.message.text)
+
+    if command is not None:
+        await command(update, context)
         return
 
+    if await relay_message(update, context): return
+
     if update.message.reply_to_message and user_id == ADMIN_CHAT_ID:
         await reply_to_user(update, context)
         return
 
-    await update.message.reply_text("You are not in a chat. Please use the buttons to start an activity.")
+    post_reply(update.message, "You are not in a chat. Please use the buttons to start an activity.")
+
+async def forward_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # photos, voice notes, stickers, videos...: never menu buttons, so no command lookup
+    if update.message.media_group_id: relayed = await relay_album_item(update, context)
+    else: relayed = await relay_message(update, context)
+    if not relayed: post_reply(update.message, "You are not in a chat. Please use the buttons to start an activity.")
 
 async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     original_message = update.message.reply_to_message.text
     try: target_user_id = int(original_message.split('`')[1])
     except (IndexError, ValueError): return
-    try:
-        await context.bot.send_message(chat_id=target_user_id, text=f"✉️ **Support Reply:**\n\n{update.message.text}", parse_mode='Markdown')
-        await update.message.reply_text(f"✅ Reply sent to user {target_user_id}.")
-    except Exception as e: await update.message.reply_text(f"❌ Failed to send reply. Error: {e}")
+    post_confirmed(target_user_id, partial(context.bot.send_message, chat_id=target_user_id, text=f"✉️ **Support Reply:**\n\n{update.message.text}", parse_mode='Markdown'),
+                   update.message, f"✅ Reply sent to user {target_user_id}.", "❌ Failed to send reply. Error: {error}", "support_reply")
 
+@timed
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id; user_data = get_user(user_id); bot_username = (await context.bot.get_me()).username
-    if not user_data: await update.message.reply_text("Could not find your profile. Please type /start."); return
+    user_id = update.effective_user.id; user_data = await get_user(user_id); bot_username = (await context.bot.get_me()).username
+    if not user_data: post_reply(update.message, "Could not find your profile. Please type /start."); return
     points, reputation = user_data.get("points", 0), user_data.get("reputation_score", 7.0)
     referral_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
     profile_text = (f"👤 **My Profile**\n\n⭐ **Reputation:** {reputation:.1f}/10.0\n💰 **Points:** {points}\n\n"
                     f"🔗 **Your Referral Link:**\n`{referral_link}`\n\n"
                     f"To redeem a code, type:\n`/redeem YOUR_CODE_HERE`" )
-    await update.message.reply_text(profile_text, parse_mode='Markdown')
+    post_reply(update.message, profile_text, parse_mode='Markdown')
+@timed
 async def redeem_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if not context.args: await update.message.reply_text("Usage: /redeem YOUR_CODE"); return
+    if not context.args: post_reply(update.message, "Usage: /redeem YOUR_CODE"); return
     code = context.args[0].upper()
-    if code not in PROMO_CODES: await update.message.reply_text("Invalid promo code."); return
-    if has_redeemed_code(user_id, code): await update.message.reply_text("You have already used this code."); return
-    points_to_add = PROMO_CODES[code]
-    grant_points(user_id, points_to_add); mark_code_as_redeemed(user_id, code)
-    new_total_points = get_user(user_id)["points"]
-    await update.message.reply_text(f"✅ Success! You redeemed {points_to_add} points. New balance: {new_total_points}.")
+    if code not in PROMO_CODES: post_reply(update.message, "Invalid promo code."); return
+    points_to_add = PROMO_CODES[code]; new_total_points = await ledger.redeem(user_id, code, points_to_add)
+    if new_total_points is None: post_reply(update.message, "You have already used this code."); return
+    post_reply(update.message, f"✅ Success! You redeemed {points_to_add} points. New balance: {new_total_points}.")
+@timed
+async def preferences(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    post_reply(update.message, "🎯 Matching preferences. Preferred age range of your partner:", reply_markup=PREF_AGE_KEYBOARD)
+    post_reply(update.message, "Preferred region of your partner:", reply_markup=PREF_REGION_KEYBOARD)
+@timed
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
+    post_reply(update.message,
         "**Commands & Features**\n\n"
         "🎮 **Random Chat**: Finds a random partner.\n"
         "🔎 **Search by Gender**: Uses 5 points to find a partner of the opposite gender.\n"
         "🛑 **End Chat**: Stops the current chat or search.\n"
         "⏭️ **Next**: Ends the current chat and finds a new partner immediately.\n"
         "👤 **My Profile**: Shows your points, reputation, and referral link.\n\n"
+        "To set the age range and region you'd like to be matched with: `/prefs`\n"
         "To redeem a code: `/redeem YOUR_CODE`\n"
         "To contact support: `/contact Your message here`",
         parse_mode='Markdown'
     )
+
+# Reply-keyboard buttons arrive as plain text; forward_message checks this before relaying.
+MENU_COMMANDS = {
+    "🎮 Random Chat": random_chat_start, "🔎 Search by Gender": gender_search_start,
+    "🛑 End Chat": end, "Next ⏭️": next_chat,
+    "👤 My Profile": show_profile, "ℹ️ Help": help_cmd
+}
+
+@timed
 async def contact_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not ADMIN_CHAT_ID: await update.message.reply_text("Contact feature is disabled."); return
+    if not ADMIN_CHAT_ID: post_reply(update.message, "Contact feature is disabled."); return
     message_text = " ".join(context.args)
-    if not message_text: await update.message.reply_text("Usage: /contact Your message here"); return
+    if not message_text: post_reply(update.message, "Usage: /contact Your message here"); return
     user_id = update.effective_user.id
     forward_text = f"Support Message from User ID: `{user_id}`\n\n---\n\n{message_text}"
-    try:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=forward_text, parse_mode='Markdown')
-        await update.message.reply_text("Your message has been sent.")
-    except Exception as e: await update.message.reply_text("Error sending message.")
+    post_confirmed(ADMIN_CHAT_ID, partial(context.bot.send_message, chat_id=ADMIN_CHAT_ID, text=forward_text, parse_mode='Markdown'),
+                   update.message, "Your message has been sent.", "Error sending message.", "contact_admin")
+
+@timed
+async def broadcast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not ADMIN_CHAT_ID or update.effective_user.id != ADMIN_CHAT_ID: return
+    parts = update.message.text.split(None, 1); text = parts[1].strip() if len(parts) > 1 else ""
+    if not text: post_reply(update.message, "Usage: /broadcast Your message here\n/broadcast stop — pause the running broadcast\n/broadcast resume — continue the last unfinished one\n/broadcast cancel — drop the unfinished one"); return
+    if text == "stop":
+        post_reply(update.message, "Broadcast stopped. Use /broadcast resume to continue." if await broadcaster.stop() else "No broadcast is running.")
+    elif broadcaster.running: post_reply(update.message, "A broadcast is already running. Use /broadcast stop first.")
+    elif text == "resume":
+        if await broadcaster.resume(context.bot, update.effective_chat.id) is None: post_reply(update.message, "There is no unfinished broadcast.")
+    elif text == "cancel":
+        broadcast_id = await broadcaster.cancel()
+        post_reply(update.message, f"Broadcast #{broadcast_id} cancelled." if broadcast_id else "There is no unfinished broadcast.")
+    elif await broadcaster.start(context.bot, text, update.effective_chat.id) is None:
+        post_reply(update.message, "There is an unfinished broadcast. Use /broadcast resume first, or /broadcast cancel to drop it.")
 
+CALLBACK_ROUTES = {}
+def callback_route(*ops):
+    """Register `handler(update, context, query, user_id, op, arg)` for callback ops; a string it returns is shown
+    to the user as the callback answer's notice."""
+    def register(handler):
+        for op in ops: CALLBACK_ROUTES[op] = handler
+        return handler
+    return register
+
+@timed
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer(); user_id = query.from_user.id; data = query.data
-    if data == "suggest_movie" or data == "suggest_anime":
-        if user_id not in active_chats: await query.edit_message_text("This chat has ended."); return
-        partner_id = active_chats[user_id]
-        suggestion_type = "movie" if data == "suggest_movie" else "anime"
-        poster_url, message = get_tmdb_suggestion(suggestion_type)
-        for p_id in [user_id, partner_id]:
-            try:
-                if poster_url: await context.bot.send_photo(p_id, photo=poster_url, caption=message, parse_mode='Markdown')
-                else: await context.bot.send_message(p_id, message, parse_mode='Markdown')
-            except Exception as e: print(f"Failed to send suggestion to {p_id}: {e}")
-        for p_id in [user_id, partner_id]:
-            try: await context.bot.send_message(p_id, "What would you like to do next?", reply_markup=in_chat_actions_keyboard())
-            except Exception: pass
-        try: await query.message.delete()
-        except: pass
-        return
-    if data == "suggest_xo":
-        if user_id not in active_chats: await query.edit_message_text("This chat has ended."); return
-        partner_id = active_chats[user_id]; pending_invites[partner_id] = user_id
-        await context.bot.send_message(partner_id, "Your partner wants to play X-O!", reply_markup=game_invite_keyboard(user_id))
-        await query.edit_message_text("Invitation sent. Waiting for partner to accept...")
-        return
-    if data.startswith("xo_accept_"):
-        inviter_id = int(data.split("_")[-1])
-        if pending_invites.get(user_id) != inviter_id: await query.edit_message_text("This invitation is invalid or has expired."); return
-        del pending_invites[user_id]
-        game = XO_Game(inviter_id, user_id); active_games[user_id] = game; active_games[inviter_id] = game
-        for p_id in [user_id, inviter_id]:
-            msg = await context.bot.send_message(p_id, f"Game started! You are {game.sym[p_id]}.\n{game.get_status()}", reply_markup=game.get_keyboard())
-            game.msgs[p_id] = msg.message_id
-        await query.message.delete(); return
-    if data.startswith("xo_decline_"):
-        inviter_id = int(data.split("_")[-1])
-        if pending_invites.get(user_id) != inviter_id: await query.edit_message_text("This invitation is invalid or has expired."); return
-        del pending_invites[user_id]
-        await context.bot.send_message(inviter_id, "Your partner declined the game invitation.")
-        await query.edit_message_text("You declined the invitation."); return
-    if data.startswith("xo_move_"):
-        if user_id not in active_games: return
-        game = active_games[user_id]
-        if user_id != game.turn: await context.bot.answer_callback_query(query.id, text="It's not your turn!"); return
-        if game.make_move(int(data.split("_")[-1]), user_id):
-            for p_id, msg_id in game.msgs.items():
-                try: await context.bot.edit_message_text(chat_id=p_id, message_id=msg_id, text=f"You are {game.sym[p_id]}.\n{game.get_status()}", reply_markup=game.get_keyboard())
-                except Exception: pass
-            if game.winner:
-                for p_id in [game.p1, game.p2]:
-                    if p_id in active_games: del active_games[p_id]
-                    await context.bot.send_message(p_id, game.get_status())
-                    await context.bot.send_message(p_id, "You can now continue chatting or suggest another activity.", reply_markup=in_chat_actions_keyboard())
-        return
-    if data.startswith("gender_"): update_user(user_id, "gender", data.split("_")[1]); await query.edit_message_text(f"Gender set: {data.split('_')[1].capitalize()}"); await check_registration(update, context)
-    elif data.startswith("age_"): update_user(user_id, "age", data.split("_")[1]); await query.edit_message_text(f"Age set: {data.split('_')[1]}"); await check_registration(update, context)
-    elif data.startswith("region_"): update_user(user_id, "region", data.split("_")[1]); await query.edit_message_text(f"Region set: {data.split('_')[1]}"); await check_registration(update, context)
-    elif data.startswith("rate_"):
-        _, rate_type, partner_id_str = data.split("_"); partner_id = int(partner_id_str)
-        partner_data = get_user(partner_id)
-        if partner_data:
-            if rate_type == "report":
-                if ADMIN_CHAT_ID:
-                    report_text = f"🚩 **User Report**\n\nUser `{user_id}` reported user `{partner_id}`."
-                    await context.bot.send_message(ADMIN_CHAT_ID, report_text, parse_mode='Markdown')
-                    await query.edit_message_text("Report sent to admin. Thank you.")
-                else:
-                    await query.edit_message_text("Report feature is currently disabled.")
-            else:
-                new_pos_ratings = partner_data["positive_ratings"] + 1; new_total_chats = partner_data["total_chats"]
-                new_rep = min(10.0, ((new_pos_ratings / new_total_chats) * 3 + 7) if new_total_chats > 0 else 7.0)
-                update_user(partner_id, "positive_ratings", new_pos_ratings); update_user(partner_id, "reputation_score", new_rep)
-                await query.edit_message_text("Thank you for your feedback!")
-        await query.message.delete()
-        return
+    query = update.callback_query; route = decode_callback(query.data); handler = route and CALLBACK_ROUTES.get(route[0]); notice = None
+    try:
+        if handler is not None: notice = await handler(update, context, query, query.from_user.id, *route)
+    finally: post_answer(query, notice)  # exactly one answer per query, with the route's notice if it returned one
 
-def main():
-    setup_database()
-    keep_alive_thread = threading.Thread(target=keep_alive); keep_alive_thread.daemon = True; keep_alive_thread.start()
-    application = Application.builder().token(TOKEN).build()
+@callback_route(CB_SUGGEST_MOVIE, CB_SUGGEST_ANIME)
+async def on_suggest(update, context, query, user_id, op, arg):
+    partner_id = await state.partner(user_id)
+    if partner_id is None: post_edit(query, "This chat has ended."); return
+    reaper.touch("chat", pair_key(user_id, partner_id))
+    poster_url, message = await suggestions.get("movie" if op == CB_SUGGEST_MOVIE else "anime", (user_id, partner_id))
+    for p_id in [user_id, partner_id]:
+        if poster_url: outbox.post(p_id, partial(context.bot.send_photo, p_id, photo=poster_url, caption=message, parse_mode='Markdown'))
+        else: outbox.post(p_id, partial(context.bot.send_message, p_id, message, parse_mode='Markdown'))
+        outbox.post(p_id, partial(context.bot.send_message, p_id, "What would you like to do next?", reply_markup=IN_CHAT_ACTIONS_KEYBOARD))
+    post_delete(query)
+
+@callback_route(CB_SUGGEST_XO)
+async def on_suggest_xo(update, context, query, user_id, op, arg):
+    partner_id = await state.partner(user_id)
+    if partner_id is None or not await state.invite(user_id, partner_id): post_edit(query, "This chat has ended."); return
+    reaper.watch("invite", (partner_id, user_id))
+    outbox.post(partner_id, partial(context.bot.send_message, partner_id, "Your partner wants to play X-O!", reply_markup=game_invite_keyboard(user_id)))
+    post_edit(query, "Invitation sent. Waiting for partner to accept...")
+
+@callback_route(CB_XO_ACCEPT)
+async def on_xo_accept(update, context, query, user_id, op, inviter_id):
+    if not await state.take_invite(user_id, inviter_id): post_edit(query, "This invitation is invalid or has expired."); return
+    reaper.forget("invite", (user_id, inviter_id))
+    game = XO_Game(inviter_id, user_id); await state.save_game(game); reaper.watch("game", pair_key(inviter_id, user_id))
+    for p_id, partner_id in [(user_id, inviter_id), (inviter_id, user_id)]:
+        board = partial(context.bot.send_message, p_id, f"Game started! You are {game.sym[p_id]}.\n{game.get_status()}", reply_markup=game.get_keyboard())
+        outbox.submit(p_id, board).add_done_callback(partial(_game_board_sent, p_id, partner_id))
+    post_delete(query)
+
+def _game_board_sent(p_id, partner_id, future):
+    # Recorded once the board is out rather than awaited in the handler, so moves edit it from then on
+    if future.cancelled() or future.exception(): return
+    asyncio.create_task(state.update_game(p_id, partial(_record_board, p_id, partner_id, future.result().message_id)))
+
+def _record_board(p_id, partner_id, msg_id, game):
+    if partner_id not in game.sym: return False  # that game is over and p_id is playing someone else
+    game.msgs[p_id] = msg_id; return True
+
+@callback_route(CB_XO_DECLINE)
+async def on_xo_decline(update, context, query, user_id, op, inviter_id):
+    if not await state.take_invite(user_id, inviter_id): post_edit(query, "This invitation is invalid or has expired."); return
+    reaper.forget("invite", (user_id, inviter_id))
+    outbox.post(inviter_id, partial(context.bot.send_message, inviter_id, "Your partner declined the game invitation."))
+    post_edit(query, "You declined the invitation.")
+
+@callback_route(CB_XO_MOVE)
+async def on_xo_move(update, context, query, user_id, op, pos):
+    if not 0 <= pos < 9: return
+    game, moved = await state.update_game(user_id, lambda game: game.make_move(pos, user_id))
+    if game is None: return
+    if not moved:
+        return "It's not your turn!" if user_id != game.turn and not game.winner else None
+    reaper.touch("game", pair_key(game.p1, game.p2)); reaper.touch("chat", pair_key(game.p1, game.p2))
+    for p_id, msg_id in game.msgs.items():
+        outbox.post(p_id, partial(context.bot.edit_message_text, chat_id=p_id, message_id=msg_id, text=f"You are {game.sym[p_id]}.\n{game.get_status()}", reply_markup=game.get_keyboard()), key=("xo", msg_id))
+    if game.winner:
+        await state.end_game(game); reaper.forget("game", pair_key(game.p1, game.p2))
+        for p_id in [game.p1, game.p2]:
+            outbox.post(p_id, partial(context.bot.send_message, p_id, game.get_status()))
+            outbox.post(p_id, partial(context.bot.send_message, p_id, "You can now continue chatting or suggest another activity.", reply_markup=IN_CHAT_ACTIONS_KEYBOARD))
+
+PROFILE_CHOICES = {CB_GENDER: ("gender", GENDERS, "Gender set: {}"), CB_AGE: ("age", AGE_RANGES, "Age set: {}"), CB_REGION: ("region", REGIONS, "Region set: {}"),
+                   CB_PREF_AGE: ("pref_age", AGE_RANGES, "Preferred age: {}"), CB_PREF_REGION: ("pref_region", REGIONS, "Preferred region: {}")}
+@callback_route(*PROFILE_CHOICES)
+async def on_profile_choice(update, context, query, user_id, op, index):
+    field, options, reply = PROFILE_CHOICES[op]
+    if not -1 <= index < len(options) or (index < 0 and not field.startswith("pref_")): return
+    value = options[index] if index >= 0 else None
+    await update_user(user_id, field, value); post_edit(query, reply.format(value.capitalize() if field == "gender" else value or "Any"))
+    if not field.startswith("pref_"): await check_registration(update, context)
+
+@callback_route(CB_RATE_POLITE, CB_RATE_RESPECT)
+async def on_rate(update, context, query, user_id, op, partner_id):
+    if await ledger.rate(partner_id, user_id): post_edit(query, "Thank you for your feedback!")
+    post_delete(query)
+
+@callback_route(CB_REPORT)
+async def on_report(update, context, query, user_id, op, partner_id):
+    if await get_user(partner_id):
+        if ADMIN_CHAT_ID:
+            report_text = f"🚩 **User Report**\n\nUser `{user_id}` reported user `{partner_id}`."
+            outbox.post(ADMIN_CHAT_ID, partial(context.bot.send_message, ADMIN_CHAT_ID, report_text, parse_mode='Markdown'))
+            post_edit(query, "Report sent to admin. Thank you.")
+        else:
+            post_edit(query, "Report feature is currently disabled.")
+    post_delete(query)
+
+async def on_startup(application: Application):
+    await state.load()
+    if isinstance(state, MemoryState): reaper.adopt(state.snapshot())
+    else: reaper.shared = state
+    application.bot_data["web"] = await build_web_server(application).start("0.0.0.0", PORT)
+    outbox.start()
+    suggestions.prefetch()
+    application.bot_data["flusher"] = asyncio.create_task(profile_cache.run_flusher(PROFILE_FLUSH_INTERVAL))
+    application.bot_data["reaper"] = asyncio.create_task(reaper.run(partial(reap_session, application.bot)))
+async def on_stop(application: Application):
+    # post_stop runs while the bot can still send; post_shutdown only after its HTTP client is closed
+    await broadcaster.stop()  # saves its checkpoint; /broadcast resume picks it up after the restart
+    for name in ("flusher", "reaper"):
+        task = application.bot_data.pop(name, None)
+        if task: task.cancel()
+    web = application.bot_data.pop("web", None)
+    if web: await web.close()
+    await outbox.close(); print(f"Outbox stats: {outbox.stats()}")
+    await suggestions.close(); print(f"Suggestion stats: {suggestions.stats()}")
+    await state.close()
+async def on_shutdown(application: Application):
+    await profile_cache.flush(); print(f"Profile cache stats: {profile_cache.stats()}"); storage.close()
+
+async def run_webhook(application: Application):
+    """Webhook mode: updates arrive on the web server's POST route and go straight into the bounded
+    update queue, which the application drains with up to CONCURRENT_UPDATES handlers at a time."""
+    stop, loop = asyncio.Event(), asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError: pass
+    await application.initialize()
+    try:
+        await on_startup(application); await application.start()
+        if WEBHOOK_URL: await application.bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        print(f"Webhook server listening on port {PORT}, path {WEBHOOK_PATH}.")
+        await stop.wait()
+    finally:
+        if application.running: await application.stop()
+        await on_stop(application); await application.shutdown(); await on_shutdown(application)
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    HANDLER_ERRORS.inc(type(context.error).__name__); print(f"Unhandled error while processing an update: {context.error!r}")
+
+def register_handlers(application: Application):
+    # Flood guard first: group -1 runs before the handlers below and can stop the update there
+    application.add_handler(TypeHandler(Update, admit_update), group=-1)
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("redeem", redeem_code))
     application.add_handler(CommandHandler("help", help_cmd))
     application.add_handler(CommandHandler("contact", contact_admin))
+    application.add_handler(CommandHandler("prefs", preferences))
+    application.add_handler(CommandHandler("broadcast", broadcast_cmd))
 
     # Message Handler for text commands and forwarding
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, forward_message))
+    # Everything else a partner can send (photos, voice, stickers, albums...) is relayed without the command lookup
+    application.add_handler(MessageHandler(filters.UpdateType.MESSAGE & ~filters.TEXT & ~filters.COMMAND & ~filters.StatusUpdate.ALL, forward_media))
 
     # Callback Query Handler for all inline buttons
     application.add_handler(CallbackQueryHandler(callback_handler))
 
-    print("Bot application (Final Stable Version - Rebuilt) is configured and starting...")
-    application.run_polling()
+    application.add_error_handler(on_error)
+
+def main():
+    setup_database()
+    builder = (Application.builder().token(TOKEN).concurrent_updates(CONCURRENT_UPDATES).update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+               .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown))
+    if BOT_MODE == "webhook": builder = builder.updater(None)
+    application = builder.build()
+    register_handlers(application)
+
+    print(f"Bot application (Final Stable Version - Rebuilt) is configured and starting in {BOT_MODE} mode...")
+    if BOT_MODE == "webhook": asyncio.run(run_webhook(application))
+    else: application.run_polling()
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,502 @@
+# loadtest.py - drives the real bot Application against a local fake Telegram Bot API.
+#
+#   python loadtest.py                         # "smoke" profile: 200 users for 20 s
+#   python loadtest.py --profile 5k            # 5000 concurrent users, 20% churn per minute, 2 minutes
+#   python loadtest.py --users 1000 --duration 60 --churn 0.5 --api-latency 0.05 --json results.json
+#   python loadtest.py --broadcast 200000 --send-rate 1e6   # /broadcast to 200k synthetic users, stopped halfway and resumed, without the 30 msg/s limit
+#   python loadtest.py --profile spam          # 20 of the users hammer Next/Search/X-O at 20 updates/s each
+#   python loadtest.py --profile spam --no-flood-guard   # the same without the per-user flood guard, for comparison
+#   python loadtest.py --profile invariants --state-backend sqlite   # Next spam without the flood guard, checking the session state as it runs
+#   python loadtest.py --profile 10k --send-rate 1e6 [--legacy-db]   # handler throughput at 10k users, optionally on the old per-call sqlite3.connect storage
+#   python loadtest.py --dispatch-bench 200000  # micro-benchmark of callback decoding, menu lookup and keyboard building
+#   python loadtest.py --matchmaker-bench 100000  # micro-benchmark of the matchmaker with 100k users waiting
+#
+# Every virtual user goes through /start, the gender/age/region buttons, then loops over Random Chat /
+# Search by Gender, relays messages, photos and albums, plays the odd X-O game, and leaves with Next or End.
+# Updates go through the application's update_queue and its CONCURRENT_UPDATES handler slots, as they do
+# in the bot, and the outbox keeps the bot's real send rates unless --send-rate overrides them. Every reply goes
+# through the outbox, so at those rates the profiles ask for several times Telegram's 30 messages/s and
+# matches/s and relays/s show that ceiling; add --send-rate 1e6 to measure the bot itself.
+# The report has p50/p99 handler latency per action (queue wait included), matches/s, relayed messages/s and event-loop lag.
+# Spammers (--spammers) are reported as one "spam" row; "well-behaved p99" covers everyone else's updates.
+# The broadcast run checks that every reachable user got the message exactly once across the stop/resume.
+# --check-state checks the session state every half second and at the end (see state_violations) and exits 1 on a violation.
+import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs
+
+from telegram.ext import Application
+
+PROFILES = {
+    "smoke": {"users": 200, "duration": 20, "churn": 0.2, "think": 1.0, "messages": 5, "api_latency": 0.01, "spammers": 0},
+    "1k": {"users": 1000, "duration": 60, "churn": 0.2, "think": 2.0, "messages": 8, "api_latency": 0.02, "spammers": 0},
+    "5k": {"users": 5000, "duration": 120, "churn": 0.2, "think": 5.0, "messages": 10, "api_latency": 0.03, "spammers": 0},
+    "10k": {"users": 10000, "duration": 120, "churn": 0.2, "think": 5.0, "messages": 10, "api_latency": 0.03, "spammers": 0},
+    "spam": {"users": 200, "duration": 30, "churn": 0.2, "think": 1.0, "messages": 5, "api_latency": 0.01, "spammers": 20},
+    "invariants": {"users": 200, "duration": 30, "churn": 0.5, "think": 0.5, "messages": 3, "api_latency": 0.01, "spammers": 20,
+                   "no_flood_guard": True, "check_state": True},
+}
+TOKEN = "123456:LOADTEST"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+ADMIN_ID, BROADCAST_FIRST_USER, BROADCAST_BLOCKED_EVERY, BROADCAST_TEXT = 42, 50_000_000, 20, "loadtest broadcast"
+
+def percentile(samples, q):
+    if not samples: return 0.0
+    ordered = sorted(samples); return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class FakeBotAPI:
+    """Answers the Bot API methods the bot uses, after an artificial round-trip delay, and counts calls.
+    Runs in its own process (see serve_fake_api) so it doesn't compete with the bot for the event loop."""
+    METHODS = ("getMe", "sendMessage", "sendPhoto", "copyMessage", "editMessageText", "answerCallbackQuery", "deleteMessage",
+               "setWebhook", "deleteWebhook", "sendMediaGroup")
+    def __init__(self, bot_module, latency):
+        self.latency, self.calls, self.texts, self._ids = latency, defaultdict(int), defaultdict(int), itertools.count(1)
+        self.broadcast, self.blocked_replies = defaultdict(int), 0
+        self.server = bot_module.HttpServer()
+        for method in self.METHODS: self.server.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+        self.server.route("GET", "/stats", self._stats)
+    async def _stats(self, headers, body):
+        return 200, "application/json", json.dumps({"calls": self.calls, "matches": self.texts["📩 Partner found!"] // 2, "broadcast": {
+            "delivered": len(self.broadcast), "duplicates": sum(n - 1 for n in self.broadcast.values()), "blocked_replies": self.blocked_replies}}).encode()
+    def _handler(self, method):
+        async def handle(headers, body):
+            if self.latency: await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()} if body else {}
+            self.calls[method] += 1; chat = {"id": int(params.get("chat_id", 0) or 0), "type": "private"}
+            if method == "sendMessage" and chat["id"] >= BROADCAST_FIRST_USER:
+                if chat["id"] % BROADCAST_BLOCKED_EVERY == 0:
+                    self.blocked_replies += 1
+                    return 403, "application/json", json.dumps({"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}).encode()
+                self.broadcast[chat["id"]] += 1
+            elif method == "sendMessage": self.texts[params.get("text", "").split(" Their", 1)[0]] += 1
+            if method == "getMe": result = BOT_USER
+            elif method == "copyMessage": result = {"message_id": next(self._ids)}
+            elif method in ("sendMessage", "sendPhoto", "editMessageText"): result = {"message_id": next(self._ids), "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": params.get("text", "")}
+            elif method == "sendMediaGroup": result = [{"message_id": next(self._ids), "date": int(time.time()), "chat": chat}]
+            else: result = True
+            return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+        return handle
+
+class TracedApplication(Application):
+    """Lets the load test put an update on update_queue, like the updater or webhook does, and wait until a
+    handler slot has finished processing it."""
+    __slots__ = ("_waiters",)
+    async def initialize(self): self._waiters = {}; await super().initialize()
+    async def process_update(self, update):
+        try: await super().process_update(update)
+        finally:
+            waiter = self._waiters.pop(update.update_id, None)
+            if waiter is not None: waiter.set_result(None)
+    async def submit(self, update):
+        waiter = self._waiters[update.update_id] = asyncio.get_running_loop().create_future()
+        await self.update_queue.put(update); await waiter
+
+class LoadTest:
+    def __init__(self, bot_module, application, options):
+        self.bot, self.app, self.options = bot_module, application, options
+        self.latency, self.counts, self.loop_lag = defaultdict(list), defaultdict(int), []
+        self._update_ids, self._message_ids, self._user_ids = itertools.count(1), itertools.count(1), itertools.count(10_000_000)
+        self._stop, self.started, self.handled = asyncio.Event(), None, 0
+        self.state_checks, self.violations = 0, []
+
+    def _user(self, user_id): return {"id": user_id, "is_bot": False, "first_name": f"vu{user_id}"}
+    def _message(self, user_id, text):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id), "text": text}
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+    def _photo(self, user_id, media_group_id=None):
+        update = self._message(user_id, ""); message = update["message"]; del message["text"]
+        message["photo"] = [{"file_id": f"photo{message['message_id']}", "file_unique_id": f"u{message['message_id']}", "width": 640, "height": 480}]
+        if media_group_id: message["media_group_id"] = media_group_id
+        return update
+    def _callback(self, user_id, data):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "menu"}
+        return {"update_id": next(self._update_ids), "callback_query": {"id": str(next(self._update_ids)), "from": self._user(user_id), "chat_instance": str(user_id), "data": data, "message": message}}
+
+    async def send(self, action, payload):
+        update = self.bot.Update.de_json(payload, self.app.bot); started = time.perf_counter()
+        await self.app.submit(update)
+        self.latency[action].append(time.perf_counter() - started); self.counts[action] += 1
+        if self.started is not None and not self._stop.is_set(): self.handled += 1  # after the ramp-up, before the stop
+
+    async def think(self): await asyncio.sleep(random.expovariate(1 / self.options.think) if self.options.think else 0)
+
+    async def play_xo(self, user_id, partner_id):
+        await self.send("suggest_xo", self._callback(user_id, self.bot.pack_callback(self.bot.CB_SUGGEST_XO)))
+        await self.send("xo_accept", self._callback(partner_id, self.bot.pack_callback(self.bot.CB_XO_ACCEPT, user_id)))
+        for _ in range(9):
+            game = await self.bot.state.get_game(user_id)
+            if game is None or game.winner: break
+            free = [i for i, cell in enumerate(game.board) if cell == " "]
+            await self.send("xo_move", self._callback(game.turn, self.bot.pack_callback(self.bot.CB_XO_MOVE, random.choice(free)))); await self.think()
+
+    async def register(self, user_id):
+        await self.send("start", self._message(user_id, "/start"))
+        for op, options in ((self.bot.CB_GENDER, self.bot.GENDERS), (self.bot.CB_AGE, self.bot.AGE_RANGES), (self.bot.CB_REGION, self.bot.REGIONS)):
+            await self.send("register", self._callback(user_id, self.bot.pack_callback(op, random.randrange(len(options)))))
+
+    async def spammer(self):
+        """Registers, then fires Next / Search by Gender / X-O moves / messages at options.spam_rate updates per second."""
+        user_id, pending = next(self._user_ids), set(); await self.register(user_id)
+        while not self._stop.is_set():
+            roll = random.random()
+            if roll < 0.5: payload = self._message(user_id, "Next ⏭️")
+            elif roll < 0.7: payload = self._message(user_id, "🔎 Search by Gender")
+            elif roll < 0.85: payload = self._callback(user_id, self.bot.pack_callback(self.bot.CB_XO_MOVE, random.randrange(9)))
+            else: payload = self._message(user_id, f"spam {random.random()}")
+            # like a real flood, the next update doesn't wait for this one, so one user's updates overlap
+            task = asyncio.create_task(self.send("spam", payload)); pending.add(task); task.add_done_callback(pending.discard)
+            await asyncio.sleep(1 / self.options.spam_rate)
+        await asyncio.gather(*pending)
+
+    async def virtual_user(self, lifetime):
+        user_id, deadline = next(self._user_ids), time.monotonic() + lifetime
+        await self.register(user_id)
+        while not self._stop.is_set() and time.monotonic() < deadline:
+            if await self.bot.state.partner(user_id) is None:
+                if random.random() < 0.2: await self.send("search_gender", self._message(user_id, "🔎 Search by Gender"))
+                else: await self.send("random_chat", self._message(user_id, "🎮 Random Chat"))
+            partner_id = await self.bot.state.partner(user_id)
+            if partner_id is None: await self.think(); continue
+            for _ in range(random.randint(1, self.options.messages)):
+                if self._stop.is_set() or await self.bot.state.partner(user_id) is None: break
+                roll = random.random()
+                if roll < 0.05:  # an album arrives as a burst of updates sharing a media_group_id
+                    group = str(next(self._update_ids))
+                    for _ in range(random.randint(2, 5)): await self.send("album_item", self._photo(user_id, group))
+                elif roll < 0.15: await self.send("photo", self._photo(user_id))
+                else: await self.send("relay", self._message(user_id, f"hello {random.random()}"))
+                await self.think()
+            partner_id = await self.bot.state.partner(user_id)
+            if partner_id is not None and random.random() < 0.1: await self.play_xo(user_id, partner_id)
+            await self.send("next" if random.random() < 0.7 else "end", self._message(user_id, "Next ⏭️" if random.random() < 0.7 else "🛑 End Chat"))
+            await self.think()
+        await self.send("leave", self._message(user_id, "🛑 End Chat"))
+
+    async def sample_loop_lag(self, interval=0.01):
+        while not self._stop.is_set():
+            started = time.perf_counter(); await asyncio.sleep(interval)
+            self.loop_lag.append(time.perf_counter() - started - interval)
+
+    async def check_state(self, final=False):
+        problems = await state_violations(self.bot, final); self.state_checks += 1
+        if problems and len(self.violations) < 100: print(f"state invariant violated: {problems[:3]}")
+        self.violations += problems
+    async def watch_state(self, interval=0.5):
+        while not self._stop.is_set(): await self.check_state(); await asyncio.sleep(interval)
+
+    async def run(self):
+        options, tasks = self.options, set()
+        # with churn c per minute a user lives on average 60/c seconds; new users replace the ones that leave
+        mean_lifetime = 60 / options.churn if options.churn else float("inf")
+        def spawn():
+            task = asyncio.create_task(self.virtual_user(random.expovariate(1 / mean_lifetime) if options.churn else float("inf")))
+            tasks.add(task); task.add_done_callback(tasks.discard)
+        sampler = asyncio.create_task(self.sample_loop_lag())
+        for i in range(options.users):  # spread the first /start wave over the ramp-up period
+            spawn(); await asyncio.sleep(options.ramp / options.users)
+        spammers = [asyncio.create_task(self.spammer()) for _ in range(options.spammers)]
+        if options.check_state: spammers.append(asyncio.create_task(self.watch_state()))
+        started = time.monotonic(); self.started = started
+        while time.monotonic() - started < options.duration:
+            await asyncio.sleep(0.5)
+            for _ in range(options.users - len(tasks)): spawn()
+        self._stop.set(); self.elapsed = time.monotonic() - started
+        await asyncio.gather(*tasks, *spammers, return_exceptions=True); await sampler
+        if options.check_state: await self.check_state(final=True)
+
+    def report(self, api_stats):
+        rows = {action: {"count": len(samples), "p50_ms": percentile(samples, 0.5) * 1000, "p99_ms": percentile(samples, 0.99) * 1000}
+                for action, samples in sorted(self.latency.items())}
+        result = {"options": vars(self.options), "elapsed_s": self.elapsed, "handlers": rows, "updates_per_s": self.handled / self.elapsed,
+                  "matches_per_s": api_stats["matches"] / self.elapsed, "relays_per_s": (api_stats["calls"].get("copyMessage", 0) + api_stats["calls"].get("sendMediaGroup", 0)) / self.elapsed,
+                  "api_calls": api_stats["calls"], "loop_lag_p50_ms": percentile(self.loop_lag, 0.5) * 1000,
+                  "loop_lag_p99_ms": percentile(self.loop_lag, 0.99) * 1000, "loop_lag_max_ms": max(self.loop_lag, default=0) * 1000,
+                  "outbox": self.bot.outbox.stats(), "profile_cache": self.bot.profile_cache.stats(),
+                  "well_behaved_p99_ms": percentile([t for action, samples in self.latency.items() if action != "spam" for t in samples], 0.99) * 1000,
+                  "flood_shed": {labels[0]: n for labels, n in self.bot.FLOOD_SHED.values.items()},
+                  "state_checks": self.state_checks, "state_violations": len(self.violations)}
+        print(f"\n{'action':<16}{'count':>9}{'p50 ms':>10}{'p99 ms':>10}")
+        for action, row in rows.items(): print(f"{action:<16}{row['count']:>9}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+        print(f"\nupdates/s {result['updates_per_s']:.1f}   matches/s {result['matches_per_s']:.1f}   relays/s {result['relays_per_s']:.1f}   "
+              f"loop lag p50 {result['loop_lag_p50_ms']:.2f} ms  p99 {result['loop_lag_p99_ms']:.2f} ms  max {result['loop_lag_max_ms']:.2f} ms")
+        print(f"well-behaved p99 {result['well_behaved_p99_ms']:.2f} ms   flood guard shed {result['flood_shed'] or 'nothing'}")
+        if self.options.check_state:
+            print(f"session state ({self.bot.STATE_BACKEND}): {self.state_checks} checks, "
+                  f"{f'{len(self.violations)} violations, first: {self.violations[0]}' if self.violations else 'no violations'}")
+        return result
+
+async def state_violations(bot_module, final=False):
+    """Check the session state the bot is running on: every chat is symmetric, nobody is paired with
+    themselves, and nobody is both waiting and in a chat. With final=True (the load has stopped) also check
+    each backend's own bookkeeping: the sqlite journal against the memory it rebuilds, and Redis' bucket
+    sorted sets against its waiting hash. Returns the violations as strings."""
+    b, state, problems = bot_module, bot_module.state, []
+    if isinstance(state, b.RedisState):
+        async with state.redis.pipeline(transaction=True) as pipe:  # MULTI/EXEC: a consistent view between two scripts
+            pipe.hgetall(state.prefix + "chats"); pipe.hgetall(state.prefix + "waiting")
+            chats, waiting = await pipe.execute()
+        chats, waiting = {int(user_id): int(partner_id) for user_id, partner_id in chats.items()}, {int(user_id): bucket for user_id, bucket in waiting.items()}
+    else:
+        snapshot = state.snapshot(); chats, waiting = snapshot["chats"], {user_id: key for _, user_id, key in snapshot["waiting"]}
+    for user_id, partner_id in chats.items():
+        if partner_id == user_id: problems.append(f"{user_id} is paired with themselves")
+        elif chats.get(partner_id) != user_id: problems.append(f"{user_id} -> {partner_id}, but {partner_id} -> {chats.get(partner_id)}")
+    problems += [f"{user_id} is waiting and in a chat with {chats[user_id]}" for user_id in waiting.keys() & chats.keys()]
+    if final and isinstance(state, b.SqliteState):
+        await b.storage.execute("SELECT 1")  # the writer runs in submission order, so every journal write has landed
+        journal_chats = {row["user_id"]: row["partner_id"] for row in await b.storage.fetchall("SELECT * FROM session_chats")}
+        journal_waiting = {row["user_id"] for row in await b.storage.fetchall("SELECT user_id FROM session_waiting")}
+        problems += [f"session_chats has {entry} for {entry[0]}, memory has {chats.get(entry[0])}" for entry in journal_chats.items() - chats.items()]
+        problems += [f"session_chats lacks {entry}" for entry in chats.items() - journal_chats.items()]
+        problems += [f"session_waiting disagrees about {user_id}" for user_id in journal_waiting ^ waiting.keys()]
+    if final and isinstance(state, b.RedisState):
+        queued = defaultdict(list)
+        async for bucket in state.redis.scan_iter(state.prefix + "q:*"):
+            for user_id in await state.redis.zrange(bucket, 0, -1): queued[int(user_id)].append(bucket)
+        problems += [f"{user_id} is queued in {buckets}, waiting hash says {waiting.get(user_id)}" for user_id, buckets in queued.items() if buckets != [waiting.get(user_id)]]
+        problems += [f"{user_id} is in the waiting hash but in no bucket" for user_id in waiting.keys() - queued.keys()]
+    return problems
+
+async def run_broadcast(bot_module, application, options, port):
+    """Seed options.broadcast users, start /broadcast as the admin, stop it halfway, try to start another one
+    (which must be refused), resume it, and check that every reachable user got exactly one copy and every
+    blocked one was marked."""
+    storage, total = bot_module.storage, options.broadcast
+    for first in range(0, total, 20000):
+        await storage.executemany("INSERT OR IGNORE INTO users (user_id, first_name) VALUES (?, ?)",
+                                  [(BROADCAST_FIRST_USER + i, f"bu{i}") for i in range(first, min(total, first + 20000))])
+    admin = LoadTest(bot_module, application, options)
+    async def command(text): await application.submit(bot_module.Update.de_json(admin._message(ADMIN_ID, text), application.bot))
+    async def progress():
+        row = await storage.fetchone("SELECT sent + failed + blocked AS done FROM broadcasts ORDER BY id DESC LIMIT 1")
+        return row["done"] if row else 0
+    started = time.monotonic(); await command(f"/broadcast {BROADCAST_TEXT}")
+    while await progress() < total // 2: await asyncio.sleep(0.05)
+    await command("/broadcast stop"); stopped_at = await progress()
+    await command("/broadcast a second message"); await command("/broadcast resume")
+    await bot_module.broadcaster.task; elapsed = time.monotonic() - started
+    async with bot_module.httpx.AsyncClient() as client: api = (await client.get(f"http://127.0.0.1:{port}/stats")).json()["broadcast"]
+    marked = (await storage.fetchone("SELECT COUNT(*) AS n FROM users WHERE blocked = 1"))["n"]
+    runs = (await storage.fetchone("SELECT COUNT(*) AS n FROM broadcasts"))["n"]
+    expected_blocked = sum(1 for i in range(total) if (BROADCAST_FIRST_USER + i) % BROADCAST_BLOCKED_EVERY == 0)
+    result = {"users": total, "elapsed_s": elapsed, "sent_per_s": (api["delivered"] + api["blocked_replies"]) / elapsed, "stopped_at": stopped_at,
+              "delivered": api["delivered"], "duplicates": api["duplicates"], "blocked_marked": marked, "blocked_expected": expected_blocked, "runs": runs,
+              "ok": api["delivered"] == total - expected_blocked and api["duplicates"] == 0 and marked == expected_blocked and runs == 1}
+    print(f"\nbroadcast to {total} users in {elapsed:.1f} s ({result['sent_per_s']:.0f} msg/s), stopped at {stopped_at} and resumed\n"
+          f"delivered {api['delivered']}, duplicates {api['duplicates']}, blocked marked {marked}/{expected_blocked}, runs {runs}: {'OK' if result['ok'] else 'MISMATCH'}")
+    return result
+
+def _legacy_route(data):
+    # The callback_handler if/startswith chain that packed callback data replaced, minus the handler bodies.
+    if data == "suggest_movie" or data == "suggest_anime": return data[8:]
+    if data == "suggest_xo": return data
+    if data.startswith("xo_accept_"): return int(data.split("_")[-1])
+    if data.startswith("xo_decline_"): return int(data.split("_")[-1])
+    if data.startswith("xo_move_"): return int(data.split("_")[-1])
+    if data.startswith("gender_"): return data.split("_")[1]
+    elif data.startswith("age_"): return data.split("_")[1]
+    elif data.startswith("region_"): return data.split("_")[1]
+    elif data.startswith("rate_"): return int(data.split("_")[2])
+
+def run_dispatch_bench(bot_module, rounds):
+    """Time the per-update dispatch work: callback decode + route, menu-button lookup, and keyboard construction,
+    each against what the handlers did before callbacks were packed and keyboards prebuilt. Prints ns per call."""
+    b = bot_module
+    legacy = ["suggest_movie", "suggest_xo", "xo_accept_123456789", "xo_move_4", "gender_female", "age_18-30", "region_Europe", "xo_decline_123456789", "rate_respect_123456789"]
+    packed = [b.pack_callback(b.CB_SUGGEST_MOVIE), b.pack_callback(b.CB_SUGGEST_XO), b.pack_callback(b.CB_XO_ACCEPT, 123456789), b.pack_callback(b.CB_XO_MOVE, 4),
+              b.pack_callback(b.CB_GENDER, 1), b.pack_callback(b.CB_AGE, 1), b.pack_callback(b.CB_REGION, 2), b.pack_callback(b.CB_XO_DECLINE, 123456789), b.pack_callback(b.CB_RATE_RESPECT, 123456789)]
+    texts = ["hello there", "Next ⏭️", "how are you?", "🛑 End Chat"]
+    boards = [tuple(random.choice("XO ") for _ in range(9)) for _ in range(64)]
+    def legacy_menu(text):
+        return {"🎮 Random Chat": b.random_chat_start, "🔎 Search by Gender": b.gender_search_start, "🛑 End Chat": b.end, "Next ⏭️": b.next_chat,
+                "👤 My Profile": b.show_profile, "ℹ️ Help": b.help_cmd}.get(text)
+    def legacy_actions_keyboard():
+        return b.InlineKeyboardMarkup([[b.InlineKeyboardButton("🎲 Suggest a Game of X-O", callback_data="suggest_xo")], [b.InlineKeyboardButton("🎬 Suggest a Movie", callback_data="suggest_movie")], [b.InlineKeyboardButton("🎌 Suggest an Anime", callback_data="suggest_anime")]])
+    routes, decode = b.CALLBACK_ROUTES, b.decode_callback
+    cases = {
+        "callback legacy chain": (legacy, _legacy_route),
+        "callback packed, uncached": (packed, lambda data: routes.get(decode.__wrapped__(data)[0])),
+        "callback packed, cached": (packed, lambda data: routes.get(decode(data)[0])),
+        "menu dict per call": (texts, legacy_menu),
+        "menu module table": (texts, b.MENU_COMMANDS.get),
+        "actions keyboard rebuilt": ([None], lambda _: legacy_actions_keyboard()),
+        "actions keyboard prebuilt": ([None], lambda _: b.IN_CHAT_ACTIONS_KEYBOARD),
+        "board keyboard rebuilt": (boards, b.board_keyboard.__wrapped__),
+        "board keyboard cached": (boards, b.board_keyboard),
+    }
+    result = {}
+    print(f"\n{'case':<28}{'ns/call':>10}")
+    for name, (inputs, fn) in cases.items():
+        calls = itertools.islice(itertools.cycle(inputs), rounds); started = time.perf_counter()
+        for item in calls: fn(item)
+        result[name] = (time.perf_counter() - started) / rounds * 1e9
+        print(f"{name:<28}{result[name]:>10.0f}")
+    return result
+
+def legacy_storage(bot_module):
+    """The storage layer as it was before Storage: a new sqlite3 connection per call, rollback journal,
+    every statement run synchronously on the event loop. For before/after comparisons (--legacy-db)."""
+    class LegacyStorage(bot_module.Storage):
+        def _open(self):
+            conn = sqlite3.connect(self.path, check_same_thread=False); conn.row_factory = sqlite3.Row
+            self._conns.append(conn); return conn
+        def _reader(self): return self._open()
+        def _writer_conn(self): return self._open()
+        def _sync(self, fn, *args):
+            try: return fn(*args)
+            finally:
+                while self._conns: self._conns.pop().close()
+        async def _run(self, op, pool, fn, *args): return self._sync(fn, *args)
+        def submit(self, statements):
+            future = concurrent.futures.Future(); future.set_result(self._sync(self._transaction, statements)); return future
+        def setup(self, script): self._sync(self._executescript, script)
+        def add_columns(self, table, columns): return self._sync(self._add_columns, table, columns)
+    return LegacyStorage(bot_module.DB_PATH)
+
+def run_matchmaker_bench(bot_module, waiting, rounds=20000):
+    """Fill a Matchmaker with `waiting` users with random profiles and preferences, then time searches (each
+    match re-enqueues the partner, so the pool stays at `waiting`), cancels, and the waiting_pool lists the
+    matchmaker replaced. Prints µs per operation."""
+    b, rng = bot_module, random.Random(1)
+    def profile():
+        return {"gender": rng.choice(b.GENDERS), "age": rng.choice(b.AGE_RANGES), "region": rng.choice(b.REGIONS),
+                "pref_age": rng.choice((None, None, *b.AGE_RANGES)), "pref_region": rng.choice((None, None, *b.REGIONS))}
+    profiles = {user_id: profile() for user_id in range(waiting)}
+    matchmaker = b.Matchmaker(); started = time.perf_counter()
+    for user_id, p in profiles.items(): matchmaker.enqueue(user_id, p)
+    result = {"enqueue": (time.perf_counter() - started) / waiting * 1e6}
+    searchers = [profile() for _ in range(1000)]; anyone = [dict(p, pref_age=None, pref_region=None) for p in searchers]
+    def search(pop, pool, genders):
+        def op(i):
+            partner_id = pop(pool[i % len(pool)], genders(pool[i % len(pool)]))
+            if partner_id is not None: matchmaker.enqueue(partner_id, profiles[partner_id])
+        return op
+    opposite = lambda p: (b.GENDERS[1 - b.GENDERS.index(p["gender"])],)
+    def cancel(i): user_id = i % waiting; matchmaker.cancel(user_id); matchmaker.enqueue(user_id, profiles[user_id])
+    # what find_partner_flow/end_chat_logic did before: two gender lists, concatenated for random picks
+    pools = {gender: [user_id for user_id, p in profiles.items() if p["gender"] == gender] for gender in b.GENDERS}
+    def legacy_random(i):
+        partner_id = rng.choice(pools["male"] + pools["female"]); pool = pools[profiles[partner_id]["gender"]]
+        pool.remove(partner_id); pool.append(partner_id)
+    def legacy_gender(i): pool = pools[b.GENDERS[i % 2]]; pool.append(pool.pop(0))
+    def legacy_cancel(i):
+        user_id = i % waiting
+        if any(user_id in pool for pool in pools.values()): pool = pools[profiles[user_id]["gender"]]; pool.remove(user_id); pool.append(user_id)
+    cases = {
+        "pop_random (no prefs)": (search(matchmaker.pop_random, anyone, lambda p: b.GENDERS), rounds),
+        "pop_random (prefs)": (search(matchmaker.pop_random, searchers, lambda p: b.GENDERS), rounds),
+        "pop_oldest (by gender)": (search(matchmaker.pop_oldest, searchers, opposite), rounds),
+        "cancel + enqueue": (cancel, rounds),
+        "legacy random pick": (legacy_random, max(1, rounds // 100)),
+        "legacy pop(0) by gender": (legacy_gender, max(1, rounds // 100)),
+        "legacy cancel": (legacy_cancel, max(1, rounds // 100)),
+    }
+    print(f"\n{waiting} users waiting\n{'case':<28}{'µs/op':>10}\n{'enqueue':<28}{result['enqueue']:>10.2f}")
+    for name, (op, n) in cases.items():
+        started = time.perf_counter()
+        for i in range(n): op(i)
+        result[name] = (time.perf_counter() - started) / n * 1e6
+        print(f"{name:<28}{result[name]:>10.2f}")
+    assert len(matchmaker) == waiting
+    return result
+
+def configure_env(options, workdir):
+    # The bot reads its configuration from the environment at import time.
+    os.environ.update({"TELEGRAM_TOKEN": TOKEN, "DB_PATH": os.path.join(workdir, "users.db"), "PORT": "0"})
+    for name in ("SEND_RATE", "CHAT_SEND_RATE", "CHAT_SEND_BURST"):
+        if options.send_rate: os.environ[name] = str(options.send_rate)
+        else: os.environ.pop(name, None)
+    os.environ.pop("TMDB_API_KEY", None); os.environ.pop("ADMIN_CHAT_ID", None)
+    if options.broadcast: os.environ["ADMIN_CHAT_ID"] = str(ADMIN_ID)
+    if options.state_backend: os.environ.update({"STATE_BACKEND": options.state_backend, "REDIS_PREFIX": f"loadtest:{os.getpid()}:"})
+    else: os.environ.pop("STATE_BACKEND", None)
+    for budget in ("RELAY", "MATCH", "CALLBACK"):
+        if options.no_flood_guard: os.environ[f"FLOOD_{budget}_RATE"] = "0"
+        else: os.environ.pop(f"FLOOD_{budget}_RATE", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def serve_fake_api(options, workdir, conn):
+    configure_env(options, workdir)
+    import bot
+    async def serve():
+        api = FakeBotAPI(bot, options.api_latency); await api.server.start("127.0.0.1", options.api_port)
+        conn.send(api.server._server.sockets[0].getsockname()[1])
+        await asyncio.get_running_loop().run_in_executor(None, conn.recv)  # any message means stop
+        await api.server.close()
+    asyncio.run(serve())
+
+async def main(options, port):
+    import bot
+    if options.legacy_db: bot.storage = bot.ledger.storage = legacy_storage(bot)
+    bot.setup_database()
+    application = (bot.Application.builder().application_class(TracedApplication).token(TOKEN).base_url(f"http://127.0.0.1:{port}/bot").updater(None)
+                   .concurrent_updates(bot.CONCURRENT_UPDATES).update_queue(asyncio.Queue(maxsize=bot.UPDATE_QUEUE_SIZE)).build())
+    bot.register_handlers(application)
+    await application.initialize(); await bot.on_startup(application); await application.start()
+    test = LoadTest(bot, application, options)
+    try:
+        if options.broadcast: result = await run_broadcast(bot, application, options, port)
+        else: await test.run()
+    finally: await application.stop(); await bot.on_stop(application); await application.shutdown(); await bot.on_shutdown(application)
+    if not options.broadcast:
+        async with bot.httpx.AsyncClient() as client: api_stats = (await client.get(f"http://127.0.0.1:{port}/stats")).json()
+        result = test.report(api_stats)
+    if options.json:
+        with open(options.json, "w") as fh: json.dump(result, fh, indent=2, default=str)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="smoke")
+    parser.add_argument("--users", type=int, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, help="seconds to run")
+    parser.add_argument("--churn", type=float, help="fraction of users replaced per minute")
+    parser.add_argument("--think", type=float, help="mean think time between a user's actions, seconds")
+    parser.add_argument("--messages", type=int, help="max messages relayed per chat")
+    parser.add_argument("--api-latency", type=float, help="fake Bot API round-trip, seconds")
+    parser.add_argument("--ramp", type=float, help="seconds over which the initial users arrive (default: a quarter of the duration, at most 10)")
+    parser.add_argument("--spammers", type=int, help="extra users that flood Next/Search/X-O moves for the whole run")
+    parser.add_argument("--spam-rate", type=float, default=20, help="updates per second sent by each spammer")
+    parser.add_argument("--no-flood-guard", action="store_true", default=None, help="turn the bot's per-user flood guard off")
+    parser.add_argument("--check-state", action="store_true", default=None, help="check the session-state invariants while the load runs; exit 1 on a violation")
+    parser.add_argument("--state-backend", choices=("memory", "sqlite", "redis"), help="STATE_BACKEND for the bot (redis uses REDIS_URL)")
+    parser.add_argument("--api-port", type=int, default=0)
+    parser.add_argument("--send-rate", type=float, help="override the outbox rate limits (global and per chat); default: the bot's own")
+    parser.add_argument("--legacy-db", action="store_true", help="run on the old per-call sqlite3.connect storage, for a before/after comparison")
+    parser.add_argument("--broadcast", type=int, metavar="USERS", help="instead of the chat load, run an admin broadcast to this many synthetic users")
+    parser.add_argument("--dispatch-bench", type=int, metavar="N", help="instead of the chat load, time N rounds of callback/menu dispatch and keyboard building")
+    parser.add_argument("--matchmaker-bench", type=int, metavar="WAITING", help="instead of the chat load, time matchmaker operations with this many users waiting")
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args(argv)
+    for key, value in PROFILES[options.profile].items():
+        if getattr(options, key) is None: setattr(options, key, value)
+    if options.ramp is None: options.ramp = min(10.0, options.duration / 4)
+    return options
+
+if __name__ == "__main__":
+    options, workdir = parse_args(), tempfile.mkdtemp(prefix="loadtest-")
+    if options.dispatch_bench or options.matchmaker_bench:
+        configure_env(options, workdir); import bot
+        result = run_dispatch_bench(bot, options.dispatch_bench) if options.dispatch_bench else run_matchmaker_bench(bot, options.matchmaker_bench)
+        if options.json:
+            with open(options.json, "w") as fh: json.dump(result, fh, indent=2)
+        sys.exit(0)
+    parent_conn, child_conn = multiprocessing.Pipe()
+    api_process = multiprocessing.Process(target=serve_fake_api, args=(options, workdir, child_conn), daemon=True); api_process.start()
+    try:
+        port = parent_conn.recv(); configure_env(options, workdir)
+        result = asyncio.run(main(options, port))
+    finally: parent_conn.send("stop"); api_process.join(5)
+    if result.get("state_violations"): sys.exit(1)